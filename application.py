@@ -10,56 +10,137 @@ from pathlib import Path
 
 import sdnotify
 import toml
+import uvloop
 
 from setproctitle import setproctitle
 import configuration.settings as cs
 
+from modules.reports.common.cron import CronSupervisor
+from modules.reports.common.dbpool import InstrumentedDBPool
+from modules.reports.common.metrics import MetricsExporter
+from modules.reports.common.render import RenderExecutor
+from modules.reports.common.logger import shared_logger
+from modules.reports.producer.consolidated import ConsolidatedRollupProducer
 from modules.reports.producer.plates import PlatesReportProducer
 from modules.reports.notifier.consumables import ConsumablesNotifier
 from modules.reports.notifier.incomings import IncomingsNotifier
 
 
 class Application:
+    """
+    Hosts reports workers in one of two modes (reports settings 'mode'):
+    process - every component in its own process with own pools (isolation)
+    single - all components on one event loop with shared pools and
+    one cron supervisor
+    """
+
     def __init__(self):
         self.__processes = []
+        self.__components = []
         self.__logger: object = None
         self.__dbconnector_is: object = None
+        self.__dbconnector_ws: object = None
+        self.__renderer: object = None
+        self.__supervisor: object = None
+        self.__exporter: object = None
         self.__eventloop = None
+        self.__eventsignal = False
         self.__name = 'reports'
+        self.__mode = 'process'
+
+    @property
+    def eventloop(self):
+        return self.__eventloop
+
+    @eventloop.setter
+    def eventloop(self, value):
+        self.__eventloop = value
+
+    @property
+    def eventsignal(self):
+        return self.__eventsignal
+
+    @eventsignal.setter
+    def eventsignal(self, value):
+        self.__eventsignal = value
 
-    def _initialize(self):
+    async def _initialize(self):
         n = sdnotify.SystemdNotifier()
-        setproctitle('reports-main')
         config = toml.load(cs.CONFIG_FILE)
-        self.__logger = AsyncLogger(f'{cs.LOG_PATH}/integration.log').getlogger()
+        reports_settings = toml.load(cs.REPORTS_FILE)
+        self.__mode = reports_settings.get('mode', 'process')
+        # metrics exporters are enabled by reports.metrics.port, in process mode
+        # every worker serves its own metrics on the following ports
+        metrics = config['reports'].get('metrics', {})
+        metrics_port = metrics.get('port')
+        metrics_host = metrics.get('host', '127.0.0.1')
+        self.__logger = await shared_logger().getlogger()
         try:
-            self.__logger = self.__logger.getlogger()
-            await self.__logger.info('Starting...')
-            self.__dbconnector_is = AsyncDBPool(host=config['integration']['rdbs']['host'],
-                                                port=config['integration']['rdbs']['port'],
-                                                login=config['integration']['rdbs']['login'],
-                                                password=config['integration']['rdbs']['password'],
-                                                database=config['integration']['rdbs']['database'])
-            await self.__dbconnector_is.connect()
-            plates_report = PlatesReportProducer()
-            plates_report_proc = Process(target=plates_report.run, name='plates_reporting')
-            self.__processes.append(plates_report_proc)
-            plates_report_proc.start()
-            consumables_notifier = ConsumablesNotifier()
-            consumables_notifier_proc = Process(target=consumables_notifier.run, name='consumables_notifier')
-            self.__processes.append(consumables_notifier_proc)
-            consumables_notifier_proc.start()
-            incomings_notifier = IncomingsNotifier()
-            incomings_notifier_proc = Process(target=incomings_notifier.run, name='incomings_notifier')
-            self.__processes.append(incomings_notifier_proc)
+            await self.__logger.info({'module': self.__name, 'msg': 'Starting...', 'mode': self.__mode})
+            self.__dbconnector_is = InstrumentedDBPool.from_configuration(config, 'integration')
+            if self.__mode == 'single':
+                self.__dbconnector_ws = InstrumentedDBPool.from_configuration(config, 'wisepark')
+                await asyncio.gather(self.__dbconnector_is.connect(), self.__dbconnector_ws.connect())
+                # only the notifiers render here
+                self.__renderer = RenderExecutor(config['reports'].get('render', {}).get('notifier_workers', 1),
+                                                 persistent=False)
+                self.__supervisor = CronSupervisor(self.__logger)
+                shared = {'dbconnector_ws': self.__dbconnector_ws,
+                          'dbconnector_is': self.__dbconnector_is,
+                          'logger': self.__logger}
+                self.__components = [PlatesReportProducer(**shared),
+                                     ConsolidatedRollupProducer(**shared),
+                                     ConsumablesNotifier(renderer=self.__renderer, **shared),
+                                     IncomingsNotifier(renderer=self.__renderer, **shared)]
+                for component in self.__components:
+                    await component._initialize()
+                    component.register(self.__supervisor)
+                if metrics_port is not None:
+                    self.__exporter = await MetricsExporter(host=metrics_host, port=metrics_port).start()
+            else:
+                await self.__dbconnector_is.connect()
+                for index, (component, name) in enumerate(((PlatesReportProducer, 'plates_reporting'),
+                                                           (ConsolidatedRollupProducer, 'consolidated_rollup'),
+                                                           (ConsumablesNotifier, 'consumables_notifier'),
+                                                           (IncomingsNotifier, 'incomings_notifier'))):
+                    exporter = None
+                    if metrics_port is not None:
+                        exporter = MetricsExporter(host=metrics_host, port=metrics_port + index)
+                    proc = Process(target=component(exporter=exporter).run, name=name)
+                    self.__processes.append(proc)
+                    proc.start()
+            n.notify('READY=1')
         except:
-            self.__logger.exception({'main': self.__name})
+            await self.__logger.exception({'module': self.__name})
+            raise
 
+    async def _dispatch(self):
+        if self.__mode == 'single':
+            await self.__supervisor.run()
+            return
+        # process mode: only watch the children
+        while not self.eventsignal:
+            for proc in list(self.__processes):
+                if not proc.is_alive() and proc.exitcode is not None:
+                    await self.__logger.error({'module': self.__name, 'msg': f'{proc.name} exited with {proc.exitcode}'})
+                    self.__processes.remove(proc)
+            await asyncio.sleep(10)
 
     async def _signal_cleanup(self):
-        await self.__logger.warning('Shutting down...')
-        await self.__dbconnector_is.disconnect()
-        await self.__dbconnector_wp.disconnect()
+        await self.__logger.warning({'module': self.__name, 'msg': 'Shutting down...'})
+        if self.__supervisor is not None:
+            self.__supervisor.stop()
+        if self.__exporter is not None:
+            await self.__exporter.stop()
+        for proc in self.__processes:
+            proc.terminate()
+        if self.__renderer is not None:
+            self.__renderer.shutdown()
+        closing_tasks = []
+        closing_tasks.append(self.__dbconnector_is.disconnect())
+        if self.__dbconnector_ws is not None:
+            closing_tasks.append(self.__dbconnector_ws.disconnect())
+        await asyncio.gather(*closing_tasks, return_exceptions=True)
         await self.__logger.shutdown()
 
     async def _signal_handler(self, signal):
@@ -69,7 +150,7 @@ class Application:
                  asyncio.tasks.current_task()]
         for t in tasks:
             t.cancel()
-        asyncio.ensure_future(self._signal_cleanup())
+        await asyncio.gather(self._signal_cleanup(), return_exceptions=True)
         # perform eventloop shutdown
         try:
             self.eventloop.stop()
@@ -80,20 +161,23 @@ class Application:
         os._exit(0)
 
     def run(self):
-        # use policy for own event loop
+        setproctitle('reports-main')
+        # use own loop
+        uvloop.install()
         self.eventloop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.eventloop)
         signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
         # add signal handler to loop
         for s in signals:
             self.eventloop.add_signal_handler(s, functools.partial(asyncio.ensure_future, self._signal_handler(s)))
-        # # try-except statement for signals
-        self.eventloop.run_until_complete(self._initialize())
-        self.eventloop.run_until_complete(self._dispatch())
+        # try-except statement for signals
+        try:
+            self.eventloop.run_until_complete(self._initialize())
+            self.eventloop.run_until_complete(self._dispatch())
+        except asyncio.CancelledError:
+            pass
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    app = Application(loop)
-    loop.run_until_complete(app.start(loop))
-    loop.run_until_complete(app.dispatch())
+    app = Application()
+    app.run()
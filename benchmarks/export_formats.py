@@ -0,0 +1,106 @@
+"""
+Rows/sec and peak RSS of the detailed report export formats on synthetic rows.
+
+    python -m modules.reports.benchmarks.export_formats --rows 200000
+
+Every format runs in a fresh process so peak RSS is not shared between them,
+'none' only generates the rows and is the baseline to compare against.
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from modules.reports.benchmarks.synthetic import DETAILED_NAMES, detailed_batches
+from modules.reports.common.exports import CsvStreamWriter, ParquetStreamWriter, available_formats
+
+
+class NullSink:
+    # counts bytes, keeps nothing
+    def __init__(self):
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+
+def blank_template(directory):
+    import openpyxl
+    path = f'{directory}/blank.xlsx'
+    openpyxl.Workbook().save(path)
+    return path
+
+
+def run_format(format, rows, chunk_size, template):
+    sink = NullSink()
+    if format == 'xlsx':
+        from modules.reports.common.templates import CompiledTemplate
+        from modules.reports.common.xlsxstream import XlsxStreamWriter
+        writer = XlsxStreamWriter(CompiledTemplate(template), sink)
+    elif format == 'csv':
+        writer = CsvStreamWriter(sink, DETAILED_NAMES)
+    elif format == 'parquet':
+        writer = ParquetStreamWriter(sink, DETAILED_NAMES)
+    else:
+        writer = None
+    started = time.perf_counter()
+    for batch in detailed_batches(rows, chunk_size):
+        if format == 'xlsx':
+            for row in batch.rows(DETAILED_NAMES):
+                writer.append(row)
+        elif writer is not None:
+            writer.write_batch(batch)
+    if writer is not None:
+        writer.close()
+    elapsed = time.perf_counter() - started
+    return {'format': format,
+            'rows': rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_sec': int(rows / elapsed) if elapsed else None,
+            'bytes': sink.size,
+            # kilobytes on Linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run(formats, rows, chunk_size, template=None):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        if template is None and 'xlsx' in formats:
+            template = blank_template(directory)
+        for format in formats:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                results.append(pool.submit(run_format, format, rows, chunk_size, template).result())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Detailed report export formats benchmark')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--formats', nargs='+', default=['none'] + available_formats())
+    parser.add_argument('--template', help='xlsx template, blank workbook by default')
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args()
+    results = run(args.formats, args.rows, args.chunk_size, args.template)
+    print(f"{'format':<8} {'rows/sec':>10} {'seconds':>8} {'MB':>8} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"{r['format']:<8} {r['rows_per_sec']:>10} {r['seconds']:>8} {r['bytes'] / 2 ** 20:>8.1f} {r['peak_rss_kb'] / 1024:>12.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'pid': os.getpid(), 'ts': time.time(), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
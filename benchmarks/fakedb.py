@@ -0,0 +1,128 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+
+from modules.reports.benchmarks.synthetic import (
+    DETAILED_NAMES,
+    consolidated_row,
+    detailed_batches,
+    devices,
+    grz_row,
+    incomings_row,
+)
+from modules.reports.producer.consolidated import CONSOLIDATED_METRICS
+
+
+class FakeDBPool:
+    """
+    Local stand-in for AsyncDBPool/StreamingDBPool answering the report
+    procedures with synthetic result sets.
+
+    Every call waits latency seconds, every streamed chunk chunk_latency
+    seconds. rows is the size of ampp_detailedrep_get and *_range results,
+    devices the number of is_column_get rows. Other procedures (inserts,
+    heartbeats) return None and are only counted.
+    """
+
+    def __init__(self, rows=1000, devices=10, latency=0.0, chunk_latency=0.0, seed=0):
+        self.__rows = rows
+        self.__devices = devices
+        self.__latency = latency
+        self.__chunk_latency = chunk_latency
+        self.__random = random.Random(seed)
+        self.calls = Counter()
+        self.returned = 0
+
+    async def connect(self):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    def stats(self):
+        return {}
+
+    def _result(self, procedure, values):
+        if procedure == 'is_column_get':
+            return devices(self.__devices)
+        if procedure in ('rep_plates_last_get', 'rep_consolidated_last_get'):
+            return {'repDate': None}
+        if procedure == 'rep_grz':
+            return grz_row(self.__random, values[1])
+        if procedure == 'rep_grz_range':
+            days = (values[1] - values[0]).days + 1
+            return [grz_row(self.__random, values[0] + timedelta(days=d), ter_id=c + 1)
+                    for c in range(self.__devices) for d in range(days)]
+        if procedure == 'rep_grz_delta':
+            row = grz_row(self.__random, values[1])
+            row['lastTransitId'] = values[2] + row['totalTransits']
+            return row
+        if procedure == 'rep_incomings':
+            return incomings_row(self.__random, values[0])
+        if procedure == 'rep_incomings_range':
+            return [incomings_row(self.__random, values[0] + timedelta(days=d)) for d in range(self.__rows)]
+        if procedure == 'ampp_consolidatedrep_get':
+            return consolidated_row(self.__random, CONSOLIDATED_METRICS)
+        if procedure == 'rep_consolidated_range_get':
+            row = consolidated_row(self.__random, CONSOLIDATED_METRICS)
+            row['days'] = (values[1] - values[0]).days + 1
+            return row
+        return None
+
+    async def callproc(self, procedure, rows=0, values=[]):
+        self.calls[procedure] += 1
+        if self.__latency:
+            await asyncio.sleep(self.__latency)
+        result = self._result(procedure, values)
+        if isinstance(result, list):
+            self.returned += len(result)
+            return result if rows == -1 else (result[0] if result else None)
+        if result is not None:
+            self.returned += 1
+        return result
+
+    async def callproc_stream(self, procedure, values=[], chunk_size=1000, columnar=False):
+        self.calls[procedure] += 1
+        if self.__latency:
+            await asyncio.sleep(self.__latency)
+        for batch in detailed_batches(self.__rows, chunk_size):
+            if self.__chunk_latency:
+                await asyncio.sleep(self.__chunk_latency)
+            self.returned += len(batch)
+            yield batch if columnar else [dict(zip(DETAILED_NAMES, row)) for row in batch.rows(DETAILED_NAMES)]
+
+
+class FakeMailer:
+    """
+    Stand-in for Mailer.send_bytes, every recipient is sent after latency.
+    """
+
+    def __init__(self, latency=0.0):
+        self.__latency = latency
+        self.sent = 0
+
+    async def send_bytes(self, data, addresses):
+        if self.__latency:
+            await asyncio.sleep(self.__latency)
+        self.sent += len(addresses)
+        return [{'address': a, 'status': 'sent', 'attempts': 1, 'error': None, 'ts': time.time()} for a in addresses]
+
+
+class NullLogger:
+    # AsyncLogger interface, drops records
+    async def info(self, record):
+        pass
+
+    async def warning(self, record):
+        pass
+
+    async def error(self, record):
+        pass
+
+    async def exception(self, record):
+        pass
+
+    async def shutdown(self):
+        pass
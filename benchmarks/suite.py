@@ -0,0 +1,191 @@
+"""
+Latency, throughput and peak memory of report generation and plates
+aggregation against FakeDBPool with synthetic result sets.
+
+    python -m modules.reports.benchmarks.suite --sizes 1000 100000 1000000 --latency 0.002
+
+Needs the deployment configuration (configuration.settings, config files and
+report templates) like the services themselves. Every scenario and size runs
+in a fresh process, results are appended to --output (JSON lines, outside
+the source tree by default) and compared with the previous run of the same
+scenario, size and latency.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from multiprocessing import get_context
+
+from modules.reports.benchmarks.fakedb import FakeDBPool, FakeMailer, NullLogger
+
+
+# plates backfill without previous reports covers 31 days
+PLATES_DAYS = 31
+
+
+def period(days=31):
+    # closed period, so rollup and cache ttl behave as for historical reports
+    stop = date.today() - timedelta(days=1)
+    start = stop - timedelta(days=days - 1)
+    return start.strftime('%Y-%m-%d 00:00:00'), stop.strftime('%Y-%m-%d 00:00:00')
+
+
+def webservice_module(directory, pool):
+    from modules.reports.common.sites import Site, SiteRegistry
+    from modules.reports.service import webservice
+    from modules.reports.service.cache import ReportCache
+    primary = webservice.SITES.primary
+    webservice.SITES = SiteRegistry([Site(primary.id, primary.name, primary.address, pool, owned=False)])
+    webservice.DBCONNECTOR_WS = pool
+    webservice.DBCONNECTOR_IS = pool
+    # nothing is kept, every run renders
+    webservice.REPORT_CACHE = ReportCache(f'{directory}/cache', size=0)
+    return webservice
+
+
+async def detailed(directory, size, latency):
+    pool = FakeDBPool(rows=size, latency=latency)
+    webservice = webservice_module(directory, pool)
+
+    async def measured():
+        await webservice.detailed_report_generator(*period(), filename=f'{directory}/detailed.xlsx')
+    return measured, pool, lambda: os.path.getsize(f'{directory}/detailed.xlsx')
+
+
+async def consolidated(directory, size, latency):
+    pool = FakeDBPool(latency=latency)
+    webservice = webservice_module(directory, pool)
+    webservice.RENDER_EXECUTOR.start()
+
+    async def measured():
+        try:
+            await webservice.consolidated_report_generator(*period(), filename=f'{directory}/consolidated.xlsx')
+        finally:
+            webservice.RENDER_EXECUTOR.shutdown()
+    return measured, pool, lambda: os.path.getsize(f'{directory}/consolidated.xlsx')
+
+
+async def plates(directory, size, latency):
+    import configuration.settings as cs
+    from modules.reports.producer.plates import PlatesReportProducer
+    pool = FakeDBPool(devices=max(1, size // PLATES_DAYS), latency=latency)
+    producer = PlatesReportProducer(dbconnector_ws=pool, dbconnector_is=pool, logger=NullLogger())
+    journal = f'{cs.TEMPORARY_DIR}/plates_units.journal'
+    if os.path.exists(journal):
+        os.remove(journal)
+
+    async def measured():
+        await producer._initialize()
+    return measured, pool, lambda: None
+
+
+async def incomings(directory, size, latency):
+    from modules.reports.common.render import RenderExecutor
+    from modules.reports.notifier.incomings import IncomingsNotifier
+    from modules.reports.notifier.outbox import Outbox
+    pool = FakeDBPool(rows=size, latency=latency)
+    renderer = RenderExecutor(1).start()
+    mailer = FakeMailer(latency)
+    notifier = IncomingsNotifier(dbconnector_ws=pool, dbconnector_is=pool, logger=NullLogger(), renderer=renderer,
+                                 outbox=Outbox(f'{directory}/outbox.db', mailer))
+    await notifier._initialize()
+
+    async def measured():
+        try:
+            await notifier._process()
+        finally:
+            renderer.shutdown()
+    return measured, pool, lambda: mailer.sent
+
+
+# name: (scenario, scales with size)
+SCENARIOS = {
+    'detailed': (detailed, True),
+    'consolidated': (consolidated, False),
+    'plates': (plates, True),
+    'incomings': (incomings, True),
+}
+
+
+async def _measure(name, size, latency):
+    with tempfile.TemporaryDirectory() as directory:
+        measured, pool, output = await SCENARIOS[name][0](directory, size, latency)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        await measured()
+        elapsed = time.perf_counter() - started
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'scenario': name,
+                'size': size,
+                'latency': latency,
+                'seconds': round(elapsed, 3),
+                'rows': pool.returned,
+                'rows_per_sec': int(pool.returned / elapsed) if elapsed else None,
+                'calls': sum(pool.calls.values()),
+                'output': output(),
+                # kilobytes on Linux
+                'peak_rss_kb': rss_peak,
+                'rss_growth_kb': rss_peak - rss_before}
+
+
+def measure(name, size, latency):
+    return asyncio.run(_measure(name, size, latency))
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def previous_results(path):
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            results[(record['scenario'], record['size'], record['latency'])] = record
+    return results
+
+
+def run(scenarios, sizes, latency, output):
+    previous = previous_results(output)
+    rev = revision()
+    print(f"{'scenario':<13} {'size':>8} {'seconds':>9} {'rows/sec':>10} {'peak RSS MB':>12} {'vs last':>8}")
+    for name in scenarios:
+        for size in (sizes if SCENARIOS[name][1] else [None]):
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                result = pool.submit(measure, name, size, latency).result()
+            result.update({'revision': rev, 'ts': time.time()})
+            last = previous.get((name, size, latency))
+            change = f"{(result['seconds'] / last['seconds'] - 1) * 100:+.0f}%" if last and last['seconds'] else '-'
+            print(f"{name:<13} {size or '-':>8} {result['seconds']:>9} {result['rows_per_sec'] or '-':>10} "
+                  f"{result['peak_rss_kb'] / 1024:>12.1f} {change:>8}")
+            with open(output, 'a') as f:
+                f.write(json.dumps(result, default=str) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports benchmark suite')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 100000, 1000000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every DB and SMTP call')
+    parser.add_argument('--output', default=f'{tempfile.gettempdir()}/reports_benchmarks.jsonl')
+    args = parser.parse_args()
+    run(args.scenarios, args.sizes, args.latency, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import islice
+
+from modules.reports.common.columnar import ColumnBatch
+
+
+# columns of ampp_detailedrep_get in A-P order
+DETAILED_NAMES = (
+    'idx',
+    'parkingId',
+    'ticketNumber',
+    'sessionNumber',
+    'traEntryTS',
+    'traPayTS',
+    'traExitTS',
+    'sessionDuration',
+    'traPlate',
+    'traPaySum',
+    'traPayPaid',
+    'traPayType',
+    'traPayChange',
+    'ticketWithoutChange',
+    'payRRN',
+    'sessionStatus',
+)
+PAY_TYPES = ('cash', 'card', 'troika', 'mobile')
+PLATE_LETTERS = 'ABEKMHOPCTYX'
+
+
+def detailed_rows(count, seed=0, start=datetime(2026, 1, 1)):
+    """
+    Yields tuples shaped like ampp_detailedrep_get rows, reproducible by seed.
+    """
+    rnd = random.Random(seed)
+    for i in range(count):
+        entry = start + timedelta(seconds=rnd.randint(0, 30 * 86400))
+        pay = entry + timedelta(minutes=rnd.randint(5, 600))
+        exit = pay + timedelta(minutes=rnd.randint(1, 15))
+        paid = Decimal(rnd.randint(0, 50) * 10)
+        plate = (f'{rnd.choice(PLATE_LETTERS)}{rnd.randint(0, 999):03d}'
+                 f'{rnd.choice(PLATE_LETTERS)}{rnd.choice(PLATE_LETTERS)}{rnd.randint(1, 799)}')
+        yield (i + 1, 1, f'{rnd.randint(0, 10 ** 12):012d}', rnd.randint(1, 10 ** 6), entry, pay, exit,
+               str(exit - entry), plate, paid, paid, rnd.choice(PAY_TYPES), Decimal(0), 0,
+               f'{rnd.randint(0, 10 ** 12):012d}', 'closed')
+
+
+def detailed_batches(count, chunk_size=1000, seed=0):
+    rows = detailed_rows(count, seed)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield ColumnBatch.from_rows(DETAILED_NAMES, chunk)
+
+
+def devices(count):
+    """
+    Rows shaped like is_column_get.
+    """
+    return [{'terId': i + 1, 'terAddress': f'10.0.{i // 250}.{i % 250 + 1}', 'terType': 1 + i % 2,
+             'terDescription': f'Стойка {i + 1}', 'camPlateMode': 1} for i in range(count)]
+
+
+def grz_row(rnd, day, ter_id=None):
+    """
+    Row shaped like rep_grz (rep_grz_range adds terId).
+    """
+    total = rnd.randint(0, 2000)
+    more = rnd.randint(0, total)
+    row = {'date': day, 'totalTransits': total, 'more6symbols': more, 'less6symbols': rnd.randint(0, total - more)}
+    if ter_id is not None:
+        row['terId'] = ter_id
+    return row
+
+
+def incomings_row(rnd, day):
+    """
+    Row shaped like rep_incomings (rep_incomings_range adds date).
+    """
+    cash, cashless, mobile = (Decimal(rnd.randint(0, 10 ** 5)) for _ in range(3))
+    return {'date': day, 'DayWeek': day.strftime('%A'), 'totalEntries': rnd.randint(0, 5000),
+            'totalExits': rnd.randint(0, 5000), 'totalPayments': rnd.randint(0, 5000), 'cashIncomings': cash,
+            'cashlessIncomings': cashless, 'mobileIncomings': mobile, 'totalIncomings': cash + cashless + mobile,
+            'lostTickets': rnd.randint(0, 20), 'totalExemptions': rnd.randint(0, 100)}
+
+
+def consolidated_row(rnd, metrics):
+    """
+    Row shaped like ampp_consolidatedrep_get for the given metric names.
+    """
+    return {key: rnd.randint(0, 10 ** 5) for key in metrics}
@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+
+class ColumnBatch:
+    """
+    Rows of one fetched chunk held as columns (one tuple per column).
+
+    Built straight from tuple cursor rows, so no dict per row is created.
+    Derived columns and totals are computed over whole columns with
+    map/sum instead of per-row Python code.
+    """
+
+    __slots__ = ('names', 'columns', 'length')
+
+    def __init__(self, names, columns, length):
+        self.names = list(names)
+        self.columns = list(columns)
+        self.length = length
+
+    @classmethod
+    def from_rows(cls, names, rows):
+        columns = list(zip(*rows)) if rows else [() for _ in names]
+        return cls(names, columns, len(rows))
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    def derive(self, name, function, *sources):
+        """
+        Adds (or replaces) column name computed as function(*source values).
+        """
+        values = tuple(map(function, *[self.column(s) for s in sources]))
+        if name in self.names:
+            self.columns[self.names.index(name)] = values
+        else:
+            self.names.append(name)
+            self.columns.append(values)
+        return self
+
+    def rows(self, names):
+        """
+        Row tuples of the given columns in the given order.
+        """
+        return zip(*[self.column(name) for name in names])
+
+    def totals(self, *names):
+        return {name: sum(v for v in self.column(name) if isinstance(v, (int, float, Decimal)))
+                for name in names if name in self}
+
+
+def accumulate(totals, batch, *names):
+    for name, value in batch.totals(*names).items():
+        # money columns stay Decimal, float sums pick up rounding errors
+        totals[name] = totals.get(name, 0) + value
+    return totals
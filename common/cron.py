@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pycron
+
+
+def next_fire(schedule, after=None, horizon=366):
+    """
+    First minute strictly after `after` matching the cron schedule.
+
+    Days and hours not matching the schedule are skipped whole, so a
+    yearly schedule takes a few hundred checks instead of every minute.
+    """
+    after = after or datetime.now()
+    dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = dt + timedelta(days=horizon)
+    fields = schedule.split()
+    day = ' '.join(['*', '*'] + fields[2:])
+    hour = ' '.join(['*'] + fields[1:])
+    while dt < limit:
+        if not pycron.is_now(day, dt):
+            dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+        elif not pycron.is_now(hour, dt):
+            dt = dt.replace(minute=0) + timedelta(hours=1)
+        elif pycron.is_now(schedule, dt):
+            return dt
+        else:
+            dt += timedelta(minutes=1)
+    raise ValueError(f'Schedule {schedule} never fires')
+
+
+class CronSupervisor:
+    """
+    Runs coroutine jobs on cron schedules from one event loop.
+
+    The loop sleeps until the nearest fire time instead of polling. A fire
+    missed by more than grace seconds (suspend, blocked loop) is skipped,
+    and a job is never started again while its previous run is active.
+    """
+
+    def __init__(self, logger=None, grace=300):
+        self.__logger = logger
+        self.__grace = timedelta(seconds=grace)
+        self.__jobs = {}
+        self.__stopped = False
+
+    def add_job(self, name, schedule, job):
+        self.__jobs[name] = {'schedule': schedule, 'job': job, 'next': next_fire(schedule), 'task': None}
+        return self
+
+    def stop(self):
+        self.__stopped = True
+        for j in self.__jobs.values():
+            if j['task'] is not None:
+                j['task'].cancel()
+
+    async def _log(self, level, msg):
+        if self.__logger is not None:
+            await getattr(self.__logger, level)({'module': 'CronSupervisor', 'msg': msg})
+
+    async def _run(self, name, job):
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._log('error', f'Job {name} failed: {e!r}')
+
+    async def run(self):
+        while not self.__stopped and self.__jobs:
+            now = datetime.now()
+            nearest = min(j['next'] for j in self.__jobs.values())
+            delay = (nearest - now).total_seconds()
+            if delay > 0:
+                # wake up at least every minute to follow clock changes
+                await asyncio.sleep(min(delay, 60))
+                continue
+            for name, j in self.__jobs.items():
+                if j['next'] > now:
+                    continue
+                if now - j['next'] > self.__grace:
+                    await self._log('warning', f'Job {name} misfired at {j["next"]}, skipped')
+                elif j['task'] is not None and not j['task'].done():
+                    await self._log('warning', f'Job {name} is still running, skipped')
+                else:
+                    j['task'] = asyncio.ensure_future(self._run(name, j['job']))
+                j['next'] = next_fire(j['schedule'], now)
@@ -0,0 +1,364 @@
+import asyncio
+import collections
+import time
+from contextlib import asynccontextmanager
+
+import aiomysql
+
+from modules.reports.common.columnar import ColumnBatch
+from modules.reports.common.metrics import REGISTRY
+from modules.reports.common.profiling import PROFILE
+
+
+DB_CALL_SECONDS = REGISTRY.histogram('reports_db_call_seconds', 'Stored procedure call latency', ('procedure',))
+DB_ROWS = REGISTRY.counter('reports_db_rows_total', 'Rows returned by stored procedures', ('procedure',))
+DB_ERRORS = REGISTRY.counter('reports_db_errors_total', 'Failed stored procedure calls', ('procedure',))
+DB_POOL_SIZE = REGISTRY.gauge('reports_db_pool_connections', 'Open connections', ('pool',))
+DB_POOL_IN_USE = REGISTRY.gauge('reports_db_pool_in_use', 'Connections in use', ('pool',))
+DB_POOL_WAITERS = REGISTRY.gauge('reports_db_pool_waiters', 'Callers waiting for a connection', ('pool',))
+DB_POOL_WAIT_SECONDS = REGISTRY.histogram('reports_db_pool_wait_seconds', 'Time to get a connection', ('pool',))
+
+# idle time after which pre_ping checks a connection before use
+PRE_PING_IDLE = 1.0
+# MySQL error: PROCEDURE does not exist
+PROCEDURE_MISSING = 1305
+
+
+def procedure_missing(exc):
+    """
+    True when exc was raised calling a stored procedure the DB schema lacks.
+    """
+    return bool(exc.args) and exc.args[0] == PROCEDURE_MISSING
+
+
+class ConnectionPool:
+    """
+    aiomysql connections of one DB between minsize and maxsize.
+
+    connect() opens minsize connections up front, further ones are opened
+    while callers wait, up to maxsize. Idle connections above minsize are
+    closed after idle seconds, the rest are pinged every keepalive seconds
+    so the server does not drop them overnight. Connections older than
+    recycle seconds are replaced, with pre_ping connections idle for a while
+    are checked before use.
+    """
+
+    def __init__(self, name, host, port, login, password, database, minsize=1, maxsize=10, recycle=3600,
+                 pre_ping=True, keepalive=300, idle=600):
+        self.name = name
+        self.__settings = {'host': host, 'port': port, 'user': login, 'password': password, 'db': database,
+                           'charset': 'utf8mb4', 'autocommit': True}
+        self.__minsize = minsize
+        self.__maxsize = maxsize
+        self.__recycle = recycle
+        self.__pre_ping = pre_ping
+        self.__keepalive = keepalive
+        self.__idle = idle
+        self.__semaphore = None
+        # (connection, opened, last used), most recently used last
+        self.__free = collections.deque()
+        self.__size = 0
+        self.__in_use = 0
+        self.__waiters = 0
+        self.__keepalive_task = None
+        self.__closed = False
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.opened = 0
+        self.closed = 0
+        self.ping_failures = 0
+
+    def stats(self):
+        return {'size': self.__size,
+                'free': len(self.__free),
+                'in_use': self.__in_use,
+                'waiters': self.__waiters,
+                'minsize': self.__minsize,
+                'maxsize': self.__maxsize,
+                'acquired': self.acquired,
+                'waited': self.waited,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'opened': self.opened,
+                'closed': self.closed,
+                'ping_failures': self.ping_failures}
+
+    def _gauges(self):
+        DB_POOL_SIZE.set(self.__size, pool=self.name)
+        DB_POOL_IN_USE.set(self.__in_use, pool=self.name)
+        DB_POOL_WAITERS.set(self.__waiters, pool=self.name)
+
+    async def _open(self):
+        self.__size += 1
+        try:
+            conn = await aiomysql.connect(**self.__settings)
+        except Exception:
+            self.__size -= 1
+            raise
+        self.opened += 1
+        return conn, time.monotonic()
+
+    def _close(self, conn):
+        conn.close()
+        self.__size -= 1
+        self.closed += 1
+
+    async def _alive(self, conn):
+        try:
+            await conn.ping(reconnect=False)
+            return True
+        except Exception:
+            self.ping_failures += 1
+            return False
+
+    async def connect(self):
+        self.__semaphore = asyncio.Semaphore(self.__maxsize)
+        self.__closed = False
+        # warm-up, the first report does not wait for connections
+        opened = await asyncio.gather(*[self._open() for _ in range(self.__minsize)])
+        now = time.monotonic()
+        self.__free.extend((conn, created, now) for conn, created in opened)
+        if self.__keepalive:
+            self.__keepalive_task = asyncio.ensure_future(self._keep_alive())
+        self._gauges()
+        return self
+
+    async def disconnect(self):
+        if self.__keepalive_task is not None:
+            self.__keepalive_task.cancel()
+            self.__keepalive_task = None
+        # connections in use are closed when they are released
+        self.__closed = True
+        while self.__free:
+            self._close(self.__free.pop()[0])
+        self._gauges()
+
+    async def _get(self):
+        now = time.monotonic()
+        while self.__free:
+            conn, created, used = self.__free.pop()
+            if conn.closed or now - created > self.__recycle:
+                self._close(conn)
+                continue
+            if self.__pre_ping and now - used > PRE_PING_IDLE and not await self._alive(conn):
+                self._close(conn)
+                continue
+            return conn, created
+        return await self._open()
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        if self.__semaphore.locked():
+            self.__waiters += 1
+            self.waited += 1
+            self._gauges()
+            try:
+                await self.__semaphore.acquire()
+            finally:
+                self.__waiters -= 1
+        else:
+            await self.__semaphore.acquire()
+        try:
+            conn, created = await self._get()
+        except BaseException:
+            self.__semaphore.release()
+            raise
+        elapsed = time.perf_counter() - started
+        self.acquired += 1
+        self.wait_seconds += elapsed
+        self.__in_use += 1
+        DB_POOL_WAIT_SECONDS.observe(elapsed, pool=self.name)
+        self._gauges()
+        try:
+            yield conn
+        except BaseException:
+            # state of a failed or cancelled query (unread results) is unknown
+            conn.close()
+            raise
+        finally:
+            self.__in_use -= 1
+            if conn.closed:
+                self.__size -= 1
+                self.closed += 1
+            elif self.__closed:
+                self._close(conn)
+            else:
+                self.__free.append((conn, created, time.monotonic()))
+            self.__semaphore.release()
+            self._gauges()
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(self.__keepalive)
+            now = time.monotonic()
+            # one at a time, a checked connection holds a slot like a caller,
+            # so callers do not open connections beyond maxsize meanwhile;
+            # extra connections idle too long are closed
+            for entry in reversed(list(self.__free)):
+                async with self.__semaphore:
+                    if entry not in self.__free:
+                        continue
+                    self.__free.remove(entry)
+                    conn, created, used = entry
+                    if self.__size > self.__minsize and now - used > self.__idle:
+                        self._close(conn)
+                    elif conn.closed or now - created > self.__recycle or not await self._alive(conn):
+                        self._close(conn)
+                    else:
+                        # back among the least recently used
+                        self.__free.appendleft(entry)
+            # refill to minsize after failures
+            while self.__size < self.__minsize:
+                try:
+                    conn, created = await self._open()
+                except Exception:
+                    break
+                self.__free.appendleft((conn, created, time.monotonic()))
+            self._gauges()
+
+
+def pool_settings(configuration, database):
+    """
+    reports.pools options merged with reports.pools.<database>:
+
+        [reports.pools]
+        minsize = 1
+        maxsize = 10
+        recycle = 3600
+        pre_ping = true
+        keepalive = 300
+        idle = 600
+        [reports.pools.wisepark]
+        maxsize = 20
+    """
+    pools = configuration['reports'].get('pools', {})
+    settings = {key: value for key, value in pools.items() if not isinstance(value, dict)}
+    settings.update(pools.get(database, {}))
+    return settings
+
+
+class InstrumentedDBPool:
+    """
+    Stored procedure calls over a ConnectionPool, recording latency,
+    returned rows and errors per procedure.
+
+    callproc(procedure, rows, values): rows=1 returns a dict or None,
+    rows=-1 all rows, rows>1 at most rows, rows=0 nothing.
+    """
+
+    def __init__(self, host, port, login, password, database, name=None, **pool):
+        self.name = name or database
+        self.__pool = ConnectionPool(self.name, host, port, login, password, database, **pool)
+
+    @classmethod
+    def from_configuration(cls, configuration, database, rdbs=None, name=None, **kwargs):
+        # database is the configuration section, wisepark or integration
+        settings = {**configuration[database]['rdbs'], **(rdbs or {})}
+        return cls(host=settings['host'],
+                   port=settings['port'],
+                   login=settings['login'],
+                   password=settings['password'],
+                   database=settings['database'],
+                   name=name or database,
+                   **{**pool_settings(configuration, database), **kwargs})
+
+    @property
+    def pool(self):
+        return self.__pool
+
+    def stats(self):
+        return {self.name: self.__pool.stats()}
+
+    async def connect(self):
+        await self.__pool.connect()
+        return self
+
+    async def disconnect(self):
+        await self.__pool.disconnect()
+
+    async def _callproc(self, procedure, rows=0, values=[]):
+        async with self.__pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.callproc(procedure, values)
+                if rows == 1:
+                    return await cur.fetchone()
+                if rows == -1:
+                    return await cur.fetchall()
+                if rows > 1:
+                    return await cur.fetchmany(rows)
+                return None
+
+    async def callproc(self, procedure, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await self._callproc(procedure, *args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(procedure=procedure)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_CALL_SECONDS.observe(elapsed, procedure=procedure)
+            profile = PROFILE.get()
+            if profile is not None:
+                profile.wait(procedure, elapsed)
+        if isinstance(result, (list, tuple)):
+            DB_ROWS.inc(len(result), procedure=procedure)
+        elif result is not None:
+            DB_ROWS.inc(procedure=procedure)
+        return result
+
+
+class StreamingDBPool(InstrumentedDBPool):
+    """
+    InstrumentedDBPool with unbuffered (server-side) cursor mode.
+
+    callproc_stream() yields batches of rows as they arrive from the server
+    instead of building a list of the whole result set, as dicts or, with
+    columnar=True, as ColumnBatch built from a tuple cursor. Streams hold
+    their connection until the last row and use a pool of their own, at most
+    stream_size connections.
+    """
+
+    def __init__(self, host, port, login, password, database, stream_size=2, name=None, **pool):
+        super().__init__(host=host, port=port, login=login, password=password, database=database, name=name,
+                         **pool)
+        self.__stream_pool = ConnectionPool(f'{self.name}_stream', host, port, login, password, database,
+                                            **{**pool, 'minsize': 0, 'maxsize': stream_size})
+
+    def stats(self):
+        return {**super().stats(), self.__stream_pool.name: self.__stream_pool.stats()}
+
+    async def connect(self):
+        await asyncio.gather(super().connect(), self.__stream_pool.connect())
+        return self
+
+    async def disconnect(self):
+        await self.__stream_pool.disconnect()
+        await super().disconnect()
+
+    async def callproc_stream(self, procedure, values=[], chunk_size=1000, columnar=False):
+        cursor = aiomysql.SSCursor if columnar else aiomysql.SSDictCursor
+        # latency of a stream is the time until its last row
+        started = time.perf_counter()
+        profile = PROFILE.get()
+        try:
+            async with self.__stream_pool.acquire() as conn:
+                async with conn.cursor(cursor) as cur:
+                    await cur.callproc(procedure, values)
+                    names = [d[0] for d in cur.description] if columnar else None
+                    if profile is not None:
+                        profile.wait(procedure, time.perf_counter() - started)
+                    while True:
+                        fetch_started = time.perf_counter() if profile is not None else None
+                        rows = await cur.fetchmany(chunk_size)
+                        if profile is not None:
+                            profile.wait(procedure, time.perf_counter() - fetch_started)
+                        if not rows:
+                            break
+                        DB_ROWS.inc(len(rows), procedure=procedure)
+                        yield ColumnBatch.from_rows(names, rows) if columnar else rows
+        except Exception:
+            DB_ERRORS.inc(procedure=procedure)
+            raise
+        DB_CALL_SECONDS.observe(time.perf_counter() - started, procedure=procedure)
@@ -0,0 +1,127 @@
+import csv
+import io
+from decimal import Decimal
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class CsvStreamWriter:
+    """
+    Writes ColumnBatch chunks as CSV to a non-seekable target.
+
+    Every batch is formatted into a small text buffer and written encoded,
+    memory does not grow with the number of rows.
+    """
+
+    def __init__(self, target, keys, headers=None, delimiter=';', encoding='utf-8-sig'):
+        self.__target = target
+        self.__keys = keys
+        self.__encoding = encoding
+        self.__buffer = io.StringIO()
+        self.__writer = csv.writer(self.__buffer, delimiter=delimiter, lineterminator='\r\n')
+        self.rows = 0
+        self.__writer.writerow(headers or keys)
+        self._flush()
+
+    def _flush(self):
+        self.__target.write(self.__buffer.getvalue().encode(self.__encoding))
+        # BOM only once at the start of the file
+        self.__encoding = 'utf-8' if self.__encoding == 'utf-8-sig' else self.__encoding
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+
+    def write_batch(self, batch):
+        self.__writer.writerows(batch.rows(self.__keys))
+        self.rows += len(batch)
+        self._flush()
+
+    def close(self):
+        self.__target.flush()
+
+
+# column types of ParquetStreamWriter, values are converted on write
+def _to_decimal(value):
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(Decimal('0.01'))
+
+
+PARQUET_TYPES = {
+    'int': (lambda: pyarrow.int64(), int),
+    'decimal': (lambda: pyarrow.decimal128(38, 2), _to_decimal),
+    'string': (lambda: pyarrow.string(), str),
+    'timestamp': (lambda: pyarrow.timestamp('us'), None),
+}
+
+
+class ParquetStreamWriter:
+    """
+    Writes ColumnBatch chunks as Parquet row groups to a non-seekable target.
+
+    types maps keys to int, decimal (38, 2), string or timestamp, so the
+    schema does not depend on the values of the first batch. Types of other
+    keys are taken from the first batch, columns without values in it are
+    typed as strings. Requires pyarrow.
+    """
+
+    def __init__(self, target, keys, types=None):
+        if pyarrow is None:
+            raise RuntimeError('pyarrow is required for parquet export')
+        self.__target = pyarrow.PythonFile(target, mode='w')
+        self.__keys = keys
+        self.__types = types or {}
+        self.__schema = None
+        self.__converters = {}
+        self.__writer = None
+        self.rows = 0
+
+    def _field(self, key, batch):
+        if key in self.__types:
+            column_type, converter = PARQUET_TYPES[self.__types[key]]
+            if converter is not None:
+                self.__converters[key] = converter
+            return pyarrow.field(key, column_type())
+        column_type = pyarrow.array(batch.column(key)).type if batch is not None else pyarrow.null()
+        if pyarrow.types.is_null(column_type):
+            column_type = pyarrow.string()
+            self.__converters[key] = str
+        elif pyarrow.types.is_decimal(column_type):
+            column_type = pyarrow.decimal128(38, 2)
+            self.__converters[key] = _to_decimal
+        return pyarrow.field(key, column_type)
+
+    def _start(self, batch):
+        self.__schema = pyarrow.schema([self._field(key, batch) for key in self.__keys])
+        self.__writer = pyarrow.parquet.ParquetWriter(self.__target, self.__schema)
+
+    def _column(self, field, batch):
+        values = batch.column(field.name)
+        converter = self.__converters.get(field.name)
+        if converter is not None:
+            values = [None if value is None else converter(value) for value in values]
+        return pyarrow.array(values, type=field.type)
+
+    def write_batch(self, batch):
+        if self.__schema is None:
+            self._start(batch)
+        table = pyarrow.Table.from_arrays([self._column(field, batch) for field in self.__schema],
+                                          schema=self.__schema)
+        self.__writer.write_table(table)
+        self.rows += len(batch)
+
+    def close(self):
+        if self.__writer is None:
+            self._start(None)
+        self.__writer.close()
+        self.__target.flush()
+
+
+def available_formats():
+    formats = ['xlsx', 'csv']
+    if pyarrow is not None:
+        formats.append('parquet')
+    return formats
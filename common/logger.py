@@ -0,0 +1,157 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime
+
+import toml
+
+import configuration.settings as cs
+from modules.reports.common.metrics import REGISTRY
+
+
+LOG_RECORDS = REGISTRY.counter('reports_log_records_total', 'Log records written', ('level',))
+LOG_DROPPED = REGISTRY.counter('reports_log_dropped_total', 'Log records dropped on a full queue', ('level',))
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+# stops the writer thread
+_STOP = object()
+
+
+class QueueLogger:
+    """
+    AsyncLogger compatible logger whose calls only enqueue the record.
+
+    A writer thread appends queued records to path as JSON lines, as many
+    as are queued (at most batch) per write. The queue holds size records,
+    records logged while it is full are dropped and counted, the writer
+    reports drops in the log. Records are serialized by the writer, so they
+    must not be changed after the call.
+    """
+
+    def __init__(self, name='reports', path=None, size=10000, batch=500, level='info'):
+        self.name = name
+        self.__path = path or f'{cs.LOG_PATH}/{name}.log'
+        self.__size = size
+        self.__batch = batch
+        self.__level = LEVELS[level]
+        self.__queue = None
+        self.__thread = None
+        self.__pid = None
+        self.__reported = 0
+        self.dropped = Counter()
+
+    def start(self):
+        # a forked worker process has the queue but not the writer thread
+        self.__pid = os.getpid()
+        self.__queue = queue.Queue(self.__size)
+        self.__thread = threading.Thread(target=self._write, name=f'{self.name}-logger', daemon=True)
+        self.__thread.start()
+        return self
+
+    async def getlogger(self):
+        if self.__thread is None or self.__pid != os.getpid():
+            self.start()
+        return self
+
+    def log(self, level, record, exc=None):
+        # plain call, usable from worker threads as well
+        if LEVELS[level] < self.__level:
+            return
+        if self.__thread is None or self.__pid != os.getpid():
+            self.start()
+        try:
+            self.__queue.put_nowait((time.time(), level, record, exc))
+        except queue.Full:
+            self.dropped[level] += 1
+            LOG_DROPPED.inc(level=level)
+
+    async def debug(self, record):
+        self.log('debug', record)
+
+    async def info(self, record):
+        self.log('info', record)
+
+    async def warning(self, record):
+        self.log('warning', record)
+
+    async def error(self, record):
+        self.log('error', record)
+
+    async def exception(self, record):
+        # traceback of the exception being handled by the caller
+        self.log('error', record, traceback.format_exc())
+
+    def _line(self, ts, level, record, exc):
+        entry = {'ts': datetime.fromtimestamp(ts).isoformat(timespec='milliseconds'),
+                 'level': level,
+                 'logger': self.name,
+                 'pid': self.__pid}
+        entry.update(record if isinstance(record, dict) else {'msg': record})
+        if exc is not None:
+            entry['exc'] = exc
+        return json.dumps(entry, ensure_ascii=False, default=str) + '\n'
+
+    def _write(self):
+        records = self.__queue
+        with open(self.__path, 'a', encoding='utf-8') as f:
+            while True:
+                batch = [records.get()]
+                while len(batch) < self.__batch:
+                    try:
+                        batch.append(records.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is _STOP
+                if stop:
+                    batch.pop()
+                lines = []
+                for ts, level, record, exc in batch:
+                    try:
+                        lines.append(self._line(ts, level, record, exc))
+                    except Exception as e:
+                        lines.append(self._line(ts, 'error', {'msg': 'Unserializable log record', 'error': repr(e)}, None))
+                    LOG_RECORDS.inc(level=level)
+                dropped = sum(self.dropped.values())
+                if dropped > self.__reported:
+                    lines.append(self._line(time.time(), 'warning',
+                                            {'msg': 'Log records dropped', 'dropped': dropped - self.__reported},
+                                            None))
+                    self.__reported = dropped
+                f.write(''.join(lines))
+                f.flush()
+                if stop:
+                    return
+
+    async def shutdown(self):
+        # writes what is queued and stops the writer
+        thread = self.__thread
+        if thread is None or self.__pid != os.getpid():
+            return
+        self.__thread = None
+        await asyncio.to_thread(self.__queue.put, _STOP)
+        await asyncio.to_thread(thread.join)
+
+
+_SHARED = {}
+
+
+def shared_logger(name='reports'):
+    """
+    Process-wide QueueLogger of name, configured by reports.logging
+    (path, size, batch, level).
+    """
+    logger = _SHARED.get(name)
+    if logger is None:
+        settings = toml.load(cs.CONFIG_FILE)['reports'].get('logging', {})
+        logger = _SHARED[name] = QueueLogger(name,
+                                             path=settings.get('path'),
+                                             size=settings.get('size', 10000),
+                                             batch=settings.get('batch', 500),
+                                             level=settings.get('level', 'info'))
+    return logger
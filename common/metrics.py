@@ -0,0 +1,166 @@
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format(self, name, key, value, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        labels = ','.join(f'{k}="{_escape(v)}"' for k, v in pairs)
+        return f'{name}{{{labels}}} {value}' if labels else f'{name} {value}'
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in list(self._values.items()):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        yield self._format(self.name, key, value)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # per bucket counts, sum, count
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            yield self._format(f'{self.name}_bucket', key, cumulative, [('le', bound)])
+        yield self._format(f'{self.name}_bucket', key, count, [('le', '+Inf')])
+        yield self._format(f'{self.name}_sum', key, total)
+        yield self._format(f'{self.name}_count', key, count)
+
+
+class Registry:
+    """
+    Process-wide metrics in Prometheus text exposition format.
+
+    Metrics are created on first use by name, a later call with the same
+    name returns the existing metric.
+    """
+
+    def __init__(self):
+        self.__metrics = {}
+
+    def _get(self, cls, name, documentation, labels, **kwargs):
+        metric = self.__metrics.get(name)
+        if metric is None:
+            metric = self.__metrics[name] = cls(name, documentation, labels, **kwargs)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._get(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self._get(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=Histogram.BUCKETS):
+        return self._get(Histogram, name, documentation, labels, buckets=buckets)
+
+    def exposition(self):
+        lines = []
+        for metric in list(self.__metrics.values()):
+            lines.extend(metric.exposition())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsExporter:
+    """
+    Minimal HTTP server answering every GET with the registry exposition,
+    for worker processes that have no web framework.
+    """
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9108):
+        self.__registry = registry
+        self.__host = host
+        self.__port = port
+        self.__server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            body = self.__registry.exposition().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         + f'Content-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+                         + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self._handle, self.__host, self.__port)
+        return self
+
+    async def stop(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
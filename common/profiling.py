@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+# profile of the current request, None when profiling is off
+PROFILE = contextvars.ContextVar('reports_profile', default=None)
+
+
+class RequestProfile:
+    """
+    Sampling profile of a single request.
+
+    A sampler thread takes stacks every interval seconds from the event loop
+    thread, only while the request coroutine is on the stack, and from
+    threads running its offloaded work (to_thread below). DB waits are
+    timed by the DB pools and kept apart from CPU samples. folded() gives
+    collapsed stacks for flamegraph.pl or speedscope, DB waits appear as
+    request;db;<procedure> converted to samples of the same interval.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.waits = Counter()
+        self.started = None
+        self.stopped = None
+        self.__root = None
+        self.__loop_thread = None
+        self.__threads = {}
+        self.__sampler = None
+        self.__running = False
+
+    def _frames(self, frame, stop):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            if frame is stop:
+                return stack[::-1]
+            frame = frame.f_back
+        return None
+
+    def _sample(self):
+        while self.__running:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            frame = frames.get(self.__loop_thread)
+            if frame is not None:
+                # not on the stack while the request awaits or other tasks run
+                stack = self._frames(frame, self.__root)
+                if stack is not None:
+                    self.samples[';'.join(['request', 'loop'] + stack)] += 1
+            for ident, root in list(self.__threads.items()):
+                frame = frames.get(ident)
+                stack = self._frames(frame, root) if frame is not None else None
+                if stack is not None:
+                    self.samples[';'.join(['request', 'thread'] + stack)] += 1
+
+    def start(self, coroutine):
+        self.__root = coroutine.cr_frame
+        self.__loop_thread = threading.get_ident()
+        self.started = time.perf_counter()
+        self.__running = True
+        self.__sampler = threading.Thread(target=self._sample, name='reports-profiler', daemon=True)
+        self.__sampler.start()
+        return coroutine
+
+    def stop(self):
+        self.__running = False
+        if self.__sampler is not None:
+            self.__sampler.join()
+        self.stopped = time.perf_counter()
+
+    def wait(self, name, seconds):
+        self.waits[name] += seconds
+
+    def call(self, function, *args):
+        # runs in a worker thread, its stack is sampled from this frame
+        self.__threads[threading.get_ident()] = sys._getframe()
+        try:
+            return function(*args)
+        finally:
+            self.__threads.pop(threading.get_ident(), None)
+
+    def summary(self):
+        wall = (self.stopped or time.perf_counter()) - self.started
+        loop = sum(v for k, v in self.samples.items() if k.startswith('request;loop;')) * self.interval
+        threads = sum(v for k, v in self.samples.items() if k.startswith('request;thread;')) * self.interval
+        return {'wall': round(wall, 3),
+                'loop_cpu': round(loop, 3),
+                'thread_cpu': round(threads, 3),
+                'db_wait': round(sum(self.waits.values()), 3),
+                'db_wait_by_procedure': {k: round(v, 3) for k, v in self.waits.items()},
+                'samples': sum(self.samples.values()),
+                'interval': self.interval}
+
+    def folded(self):
+        lines = [f'{stack} {count}' for stack, count in self.samples.most_common()]
+        for name, seconds in self.waits.most_common():
+            lines.append(f'request;db;{name} {max(1, int(seconds / self.interval))}')
+        return '\n'.join(lines) + '\n'
+
+
+async def profile(coroutine, interval=0.005):
+    """
+    Awaits coroutine with a RequestProfile active in its context.
+    """
+    request_profile = RequestProfile(interval)
+    token = PROFILE.set(request_profile)
+    try:
+        await request_profile.start(coroutine)
+    finally:
+        request_profile.stop()
+        PROFILE.reset(token)
+    return request_profile
+
+
+async def to_thread(function, *args):
+    """
+    asyncio.to_thread that keeps the offloaded work in the request profile.
+    """
+    request_profile = PROFILE.get()
+    if request_profile is None:
+        return await asyncio.to_thread(function, *args)
+    return await asyncio.to_thread(request_profile.call, function, *args)
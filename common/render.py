@@ -0,0 +1,103 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from openpyxl.utils import get_column_letter
+
+from modules.reports.common.metrics import REGISTRY
+from modules.reports.common.templates import TemplateCache
+from modules.reports.common.xlsxstream import XlsxStreamWriter
+
+
+# compiled templates of the worker process
+TEMPLATE_CACHE = TemplateCache()
+
+RENDER_SECONDS = REGISTRY.histogram('reports_render_seconds', 'Report render time', ('report', 'format'))
+RENDER_ROWS = REGISTRY.counter('reports_render_rows_total', 'Data rows written to reports', ('report', 'format'))
+RENDER_BYTES = REGISTRY.counter('reports_render_bytes_total', 'Serialized report bytes', ('report', 'format'))
+
+
+def _cell_values(values=None, rows=None):
+    values = dict(values or {})
+    if rows is not None:
+        first_row, data = rows
+        for row_idx, row in enumerate(data, first_row):
+            for col_idx, value in enumerate(row, 1):
+                values[f"{get_column_letter(col_idx)}{row_idx}"] = value
+    return values
+
+
+# runs in the worker process, arguments must be plain data
+def render_template(template, values=None, appends=None, rows=None, title=None, sheets=None):
+    """
+    Fill a workbook template and return serialized xlsx.
+
+    values: {coordinate: value} written as is
+    appends: {coordinate: text} appended to the template text of the cell
+    rows: (first_row, [[value, ...], ...]) written from column A
+    sheets: [{values, appends, rows, title}, ...] a sheet of the template
+    per item instead of the arguments above
+    """
+    if sheets is None:
+        sheets = [{'values': values, 'appends': appends, 'rows': rows, 'title': title}]
+    compiled = TEMPLATE_CACHE.get(template)
+    output = BytesIO()
+    writer = None
+    for sheet in sheets:
+        values = _cell_values(sheet.get('values'), sheet.get('rows'))
+        if writer is None:
+            writer = XlsxStreamWriter(compiled, output, values=values, appends=sheet.get('appends'),
+                                      title=sheet.get('title'))
+        else:
+            writer.add_sheet(compiled, values=values, appends=sheet.get('appends'), title=sheet.get('title'))
+    writer.close()
+    return output.getvalue()
+
+
+class RenderExecutor:
+    """
+    Process pool for CPU-bound workbook rendering.
+
+    The event loop only awaits the result, so several reports are rendered
+    in parallel without blocking the service or the notifier loops.
+    Workers default to the CPU count. A pool that is not persistent is
+    shut down when no render is running, for rarely rendering processes.
+    """
+
+    def __init__(self, workers=None, persistent=True):
+        self.__workers = workers
+        self.__persistent = persistent
+        self.__running = 0
+        self.__pool = None
+
+    def start(self):
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(max_workers=self.__workers,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        return self
+
+    async def render(self, template, **kwargs):
+        self.start()
+        loop = asyncio.get_running_loop()
+        report = Path(template).stem
+        self.__running += 1
+        try:
+            with RENDER_SECONDS.time(report=report, format='xlsx'):
+                content = await loop.run_in_executor(self.__pool, functools.partial(render_template, template, **kwargs))
+        finally:
+            self.__running -= 1
+            if not self.__persistent and not self.__running:
+                self.shutdown()
+        for sheet in kwargs.get('sheets') or [kwargs]:
+            if sheet.get('rows') is not None:
+                RENDER_ROWS.inc(len(sheet['rows'][1]), report=report, format='xlsx')
+        RENDER_BYTES.inc(len(content), report=report, format='xlsx')
+        return content
+
+    def shutdown(self):
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+            self.__pool = None
@@ -0,0 +1,190 @@
+import asyncio
+import pickle
+import tempfile
+
+import configuration.settings as cs
+from modules.reports.common.dbpool import InstrumentedDBPool
+
+
+class Site:
+    def __init__(self, id, name, address, dbconnector, owned=True):
+        self.id = id
+        self.name = name
+        self.address = address
+        self.dbconnector = dbconnector
+        # pools passed in by the caller are connected and closed by it
+        self.owned = owned
+
+
+def sum_records(records, keys):
+    """
+    Sums keys of dict rows, missing rows and values count as 0.
+    """
+    totals = dict.fromkeys(keys, 0)
+    for record in records:
+        for key in keys:
+            totals[key] += (record or {}).get(key) or 0
+    return totals
+
+
+class SiteRegistry:
+    """
+    Parkings served by one deployment, each with its own WisePark DB pool.
+
+    The primary site is configuration ampp/wisepark, further sites are
+    listed in reports.sites:
+
+        [[reports.sites]]
+        id = 2
+        name = "..."
+        address = "..."
+        rdbs = {host = "...", database = "..."}  # overrides of wisepark.rdbs
+
+    Per-site queries run at most concurrency sites at a time. Results
+    read ahead of the consumer are spooled, in memory up to spool bytes.
+    """
+
+    def __init__(self, sites, concurrency=4, spool=16 * 1024 * 1024):
+        self.__sites = {site.id: site for site in sites}
+        self.__concurrency = concurrency
+        self.__spool = spool
+        self.primary = sites[0]
+
+    @classmethod
+    def from_configuration(cls, configuration, pool_class=InstrumentedDBPool, dbconnector=None):
+        sites = [Site(configuration['ampp']['id'],
+                      cs.AMPP,
+                      configuration['ampp'].get('address', cs.AMPP_PARKING_ADDRESS),
+                      dbconnector or pool_class.from_configuration(configuration, 'wisepark'),
+                      owned=dbconnector is None)]
+        for settings in configuration['reports'].get('sites', []):
+            if settings['id'] == sites[0].id:
+                continue
+            sites.append(Site(settings['id'],
+                              settings.get('name', settings.get('address', '')),
+                              settings.get('address', ''),
+                              pool_class.from_configuration(configuration, 'wisepark', settings.get('rdbs', {}),
+                                                            name=f"wisepark_{settings['id']}")))
+        return cls(sites,
+                   configuration['reports'].get('site_concurrency', 4),
+                   configuration['reports'].get('site_spool', 16 * 1024 * 1024))
+
+    @property
+    def ids(self):
+        return list(self.__sites)
+
+    def __len__(self):
+        return len(self.__sites)
+
+    def __iter__(self):
+        return iter(self.__sites.values())
+
+    def select(self, ids=None):
+        """
+        Sites by ids in the given order, all for 'all', primary when empty.
+        Raises KeyError for unknown ids.
+        """
+        ids = [str(i).strip() for i in (ids or []) if str(i).strip()]
+        if not ids:
+            return [self.primary]
+        if ids == ['all']:
+            return list(self)
+        sites = {str(site.id): site for site in self}
+        return [sites[i] for i in dict.fromkeys(ids)]
+
+    def stats(self):
+        stats = {}
+        for site in self:
+            stats.update(site.dbconnector.stats())
+        return stats
+
+    async def connect(self):
+        await asyncio.gather(*[site.dbconnector.connect() for site in self if site.owned])
+        return self
+
+    async def disconnect(self):
+        await asyncio.gather(*[site.dbconnector.disconnect() for site in self if site.owned],
+                             return_exceptions=True)
+
+    async def gather(self, function, sites):
+        """
+        Results of function(site) in sites order.
+        """
+        semaphore = asyncio.Semaphore(self.__concurrency)
+
+        async def call(site):
+            async with semaphore:
+                return await function(site)
+        return await asyncio.gather(*[call(site) for site in sites])
+
+    # reads the whole result of a following site, so its DB stream is not
+    # held open while the sites before it are consumed
+    async def _spool(self, semaphore, function, site):
+        spool = tempfile.SpooledTemporaryFile(self.__spool)
+        try:
+            async with semaphore:
+                async for item in function(site):
+                    pickle.dump(item, spool, pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+    @staticmethod
+    async def _unspool(task):
+        spool = await task
+        try:
+            while True:
+                try:
+                    yield pickle.load(spool)
+                except EOFError:
+                    return
+        finally:
+            spool.close()
+
+    @staticmethod
+    def _cancel(tasks):
+        for task in tasks:
+            task.cancel()
+        # spools of sites not consumed
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                task.result().close()
+
+    async def ordered(self, function, sites):
+        """
+        Yields (site, items) in sites order, items iterates the function(site)
+        async generator. The first site is streamed, following sites are
+        fetched meanwhile into spools.
+        """
+        semaphore = asyncio.Semaphore(self.__concurrency)
+        tasks = [asyncio.ensure_future(self._spool(semaphore, function, site)) for site in sites[1:]]
+        try:
+            if sites:
+                yield sites[0], function(sites[0])
+            for site, task in zip(sites[1:], tasks):
+                yield site, self._unspool(task)
+        finally:
+            self._cancel(tasks)
+
+    async def merged(self, function, sites):
+        """
+        Yields (site, item) of function(site) async generators of all sites.
+        The first site is streamed, following sites are fetched meanwhile
+        into spools and yielded as they complete.
+        """
+        semaphore = asyncio.Semaphore(self.__concurrency)
+        tasks = {asyncio.ensure_future(self._spool(semaphore, function, site)): site for site in sites[1:]}
+        try:
+            if sites:
+                async for item in function(sites[0]):
+                    yield sites[0], item
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    async for item in self._unspool(task):
+                        yield tasks[task], item
+        finally:
+            self._cancel(tasks)
@@ -0,0 +1,86 @@
+import os
+from copy import copy
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
+
+
+class CompiledTemplate:
+    """
+    Parsed report template: static cell values and styles, merged ranges
+    and dimensions of the active sheet.
+
+    Slots are addressed by coordinate, values replace the template value,
+    appends are added to the template text (e.g. header captions).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        wb = openpyxl.load_workbook(path)
+        ws = wb.active
+        self.title = ws.title
+        self.column_widths = {key: dimension.width for key, dimension in ws.column_dimensions.items()}
+        self.row_heights = {key: dimension.height for key, dimension in ws.row_dimensions.items()
+                            if dimension.height is not None}
+        self.merged = [merged.coord for merged in ws.merged_cells.ranges]
+        self.rows = []
+        for row in ws.iter_rows():
+            cells = []
+            for c in row:
+                style = None
+                if c.has_style:
+                    style = (copy(c.font), copy(c.fill), copy(c.border), copy(c.alignment),
+                             copy(c.protection), c.number_format)
+                cells.append((c.coordinate, c.value, style))
+            self.rows.append(cells)
+
+    def cells(self, ws, values=None, appends=None):
+        """
+        Yield template rows as write-only cells with slots filled.
+        Values addressed below the template are yielded as extra rows.
+        """
+        values = values or {}
+        appends = appends or {}
+        for row in self.rows:
+            cells = []
+            for coordinate, value, style in row:
+                if coordinate in values:
+                    value = values[coordinate]
+                elif coordinate in appends:
+                    value = f"{value or ''}{appends[coordinate]}"
+                cell = WriteOnlyCell(ws, value=value)
+                if style is not None:
+                    cell.font, cell.fill, cell.border, cell.alignment, cell.protection, cell.number_format = style
+                cells.append(cell)
+            yield cells
+        extra = {}
+        for coordinate, value in values.items():
+            column, row_idx = coordinate_from_string(coordinate)
+            if row_idx > len(self.rows):
+                extra.setdefault(row_idx, {})[column_index_from_string(column)] = value
+        for row_idx in range(len(self.rows) + 1, max(extra, default=0) + 1):
+            row = extra.get(row_idx, {})
+            yield [row.get(col_idx) for col_idx in range(1, max(row, default=0) + 1)]
+
+
+class TemplateCache:
+    """
+    Compiled templates by path, recompiled when the file mtime changes.
+    """
+
+    def __init__(self):
+        self.__templates = {}
+
+    def get(self, path):
+        template = self.__templates.get(path)
+        if template is None or os.path.getmtime(path) != template.mtime:
+            template = CompiledTemplate(path)
+            self.__templates[path] = template
+        return template
+
+    def preload(self, *paths):
+        for path in paths:
+            self.get(path)
+        return self
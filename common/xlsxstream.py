@@ -0,0 +1,91 @@
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import openpyxl
+from openpyxl.worksheet._writer import WorksheetWriter
+from openpyxl.writer.excel import ExcelWriter
+
+
+class ChunkSink:
+    """
+    Non-seekable file-like buffer, drained by the caller between writes.
+    """
+
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.__position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.__buffer += data
+        self.__position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.__position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.__buffer)
+        self.__buffer.clear()
+        return data
+
+
+class _StreamExcelWriter(ExcelWriter):
+    # worksheet part is already in the archive, only register it in manifest
+    def write_worksheet(self, ws):
+        ws._rels = ws._writer._rels
+        self.manifest.append(ws)
+
+
+class XlsxStreamWriter:
+    """
+    Write-only workbook seeded with a compiled template.
+
+    Template rows, styles, merged ranges and column widths are written once
+    with the slots filled, data rows are serialized straight into the zip
+    entry of the sheet, so memory does not depend on rows count.
+    add_sheet() finishes the current sheet and starts the next one.
+    """
+
+    def __init__(self, template, target, values=None, appends=None, title=None):
+        self.__workbook = openpyxl.Workbook(write_only=True)
+        self.__archive = ZipFile(target, 'w', ZIP_DEFLATED, allowZip64=True)
+        self.__worksheet = None
+        self.__entry = None
+        self.rows = 0
+        self.add_sheet(template, values, appends, title)
+
+    def _copy_layout(self, template):
+        for key, width in template.column_widths.items():
+            self.__worksheet.column_dimensions[key].width = width
+        for key, height in template.row_heights.items():
+            self.__worksheet.row_dimensions[key].height = height
+        for merged in template.merged:
+            self.__worksheet.merged_cells.add(merged)
+
+    def _close_sheet(self):
+        if self.__worksheet is not None:
+            self.__worksheet.close()
+            self.__entry.close()
+
+    def add_sheet(self, template, values=None, appends=None, title=None):
+        self._close_sheet()
+        self.__worksheet = self.__workbook.create_sheet(title or template.title)
+        # sheets are numbered in order, as ExcelWriter does on save
+        self.__worksheet._id = len(self.__workbook.worksheets)
+        self._copy_layout(template)
+        self.__entry = self.__archive.open(self.__worksheet.path[1:], 'w', force_zip64=True)
+        self.__worksheet._writer = WorksheetWriter(self.__worksheet, out=self.__entry)
+        self.__worksheet._writer.write_top()
+        for cells in template.cells(self.__worksheet, values, appends):
+            self.__worksheet.append(cells)
+
+    def append(self, values):
+        self.__worksheet.append(values)
+        self.rows += 1
+
+    def close(self):
+        self._close_sheet()
+        _StreamExcelWriter(self.__workbook, self.__archive).save()
@@ -3,13 +3,16 @@ from email.message import EmailMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
-import aiosmtplib
 import configuration.settings as cs
-from utils.asyncsql import AsyncDBPool
+from modules.reports.common.cron import CronSupervisor
+from modules.reports.common.dbpool import InstrumentedDBPool
+from modules.reports.common.render import RenderExecutor
+from modules.reports.common.logger import shared_logger
+from modules.reports.notifier.incomings import INCOMINGS_COLUMNS
+from modules.reports.notifier.mailer import Mailer, SMTPPool
+from modules.reports.notifier.outbox import Outbox
 from datetime import datetime, date, timedelta
-import openpyxl
 from email.mime.text import MIMEText
-from pathlib import Path
 import signal
 import os
 import functools
@@ -18,12 +21,19 @@ import toml
 
 
 class ConsumablesNotifier:
-    def __init__(self):
+    # pools, logger and renderer are shared when hosted by single process Application
+    def __init__(self, dbconnector_ws=None, dbconnector_is=None, logger=None, renderer=None, outbox=None,
+                 exporter=None):
         self.__eventsignal = False
         self.__eventloop: object = None
-        self.__logger: object = None
-        self.__dbconnector_ws: object = None
-        self.__dbconnector_is: object = None
+        self.__logger: object = logger
+        self.__exporter: object = exporter
+        self.__dbconnector_ws: object = dbconnector_ws
+        self.__dbconnector_is: object = dbconnector_is
+        self.__renderer: object = renderer
+        self.__supervisor: object = None
+        self.__mailer: object = None
+        self.__outbox: object = outbox
         self.name = 'ConsumablesNotifier'
         self.type = 'notify'
         self.alias = 'consumables'
@@ -42,102 +52,112 @@ class ConsumablesNotifier:
         self.__eventsignal = v
 
     async def _initialize(self):
-        setproctitle('rep-consumables')
         configuration = toml.load(cs.CONFIG_FILE)
-        self.__dbconnector_ws = AsyncDBPool(host=configuration['wisepark']['rdbs']['host'],
-                                            port=configuration['wisepark']['rdbs']['port'],
-                                            login=configuration['wisepark']['rdbs']['login'],
-                                            password=configuration['wisepark']['rdbs']['password'],
-                                            database=configuration['wisepark']['rdbs']['integration'])
-        self.__dbconnector_is = AsyncDBPool(host=configuration['integration']['rdbs']['host'],
-                                            port=configuration['integration']['rdbs']['port'],
-                                            login=configuration['integration']['rdbs']['login'],
-                                            password=configuration['integration']['rdbs']['password'],
-                                            database=configuration['integration']['rdbs']['integration'])
+        if self.__logger is None:
+            self.__logger = await shared_logger().getlogger()
         connections_tasks = []
-        connections_tasks.append(self.__dbconnector_is.connect())
-        connections_tasks.append(self.__dbconnector_ws.connect())
+        if self.__dbconnector_ws is None:
+            self.__dbconnector_ws = InstrumentedDBPool.from_configuration(configuration, 'wisepark')
+            connections_tasks.append(self.__dbconnector_ws.connect())
+        if self.__dbconnector_is is None:
+            self.__dbconnector_is = InstrumentedDBPool.from_configuration(configuration, 'integration')
+            connections_tasks.append(self.__dbconnector_is.connect())
+        if self.__renderer is None:
+            # renders once a period, one worker spawned per render
+            self.__renderer = RenderExecutor(configuration['reports'].get('render', {}).get('notifier_workers', 1),
+                                             persistent=False)
         await asyncio.gather(*connections_tasks)
         reports_settings = toml.load(cs.REPORTS_FILE)
         self.__schedule = reports_settings['notify']['consumables']['schedule']
         self.__addresses = reports_settings['notify']['consumables']['addresses']
         self.__template = reports_settings['notify']['consumables']['template']
+        smtp = configuration['reports'].get('smtp', {})
+        self.__mailer = Mailer(SMTPPool(hostname=cs.REPORTS_SMTP_HOST,
+                                        port=cs.REPORTS_SMTP_PORT,
+                                        username=cs.REPORTS_SMTP_LOGIN,
+                                        password=cs.REPORTS_SMTP_PASSWORD,
+                                        use_tls=False,
+                                        start_tls=True,
+                                        size=smtp.get('pool', 2)),
+                               cs.REPORTS_SMTP_ADDRESS,
+                               concurrency=smtp.get('concurrency', 4),
+                               retries=smtp.get('retries', 3))
+        outbox = reports_settings['notify'].get('outbox', {})
+        self.__drain_schedule = outbox.get('schedule', '*/5 * * * *')
+        if self.__outbox is None:
+            self.__outbox = Outbox(outbox.get('path', f'{cs.TEMPORARY_DIR}/reports_outbox.db'),
+                                   self.__mailer,
+                                   max_attempts=outbox.get('attempts', 10),
+                                   backoff=outbox.get('backoff', 60),
+                                   retention=outbox.get('retention', 30 * 24 * 60 * 60))
         return self
 
     async def _process(self):
+        today = date.today()
+        # middle of the previous month
+        from_day = (today.replace(day=1) - timedelta(days=1)).replace(day=15)
+        weeknum = from_day.isocalendar()[1]
+        period = f'{from_day.year}-{from_day.month:02d}'
         try:
-            today = date.today()
-            
-            from_day = today.replace(day=15, month=today.month-1)
-
-            data = await self.__dbconnector_ws.callproc('rep_consumables', rows=1, values=[date])
-            wb = openpyxl.load_workbook(f'{cs.RESOURCES}/ampp/{self.__template}')
-            ws = wb.active
-            rows = [row for row in ws.iter_rows(min_row=2, max_row=8)]
-            for row, val in zip(rows, data):
-                ws.cell(column=1, row=row[0].row).value = val['DayWeek']
-                ws.cell(column=2, row=row[0].row).value = val['totalEntries']
-                ws.cell(column=3, row=row[0].row).value = val['totalExits']
-                ws.cell(column=4, row=row[0].row).value = val['totalPayments']
-                ws.cell(column=5, row=row[0].row).value = val['cashIncomings']
-                ws.cell(column=6, row=row[0].row).value = val['cashlessIncomings']
-                ws.cell(column=7, row=row[0].row).value = val['mobileIncomings']
-                ws.cell(column=8, row=row[0].row).value = val['totalIncomings']
-                ws.cell(column=9, row=row[0].row).value = val['lostTickets']
-                ws.cell(column=10, row=row[0].row).value = val['totalExemptions']
-            file = f"{cs.AMPP_PARKING_ID}_неделя_{weeknum}_доходность.xlsx"
-            wb.save(file)
-            for address in self.__addresses:
-                # send data
-                if len(address) > 0:
-                    message = MIMEMultipart()
-                    message["From"] = cs.REPORTS_SMTP_ADDRESS
-                    message["To"] = address
-                    message["Subject"] = f'Доходность {cs.AMPP_PARKING_ID}'
-                    plain_text_message = MIMEText(f"Неделя:{weeknum}\nМесяц:{from_day.month}\nГод:{from_day.year}\n", "plain", "utf-8")
-                    message.attach(plain_text_message)
-                    fp = open(file, 'rb')
-                    attachment = MIMEApplication(fp.read(), _subtype="xlsx")
-                    fp.close()
-                    filename = f'{Path(file).name}'
-                    attachment.add_header('Content-Disposition', 'attachment', filename=filename)
-                    message.attach(attachment)
-                    plain_text_message = MIMEText("\nАвтоматизированная система генерации отчетов")
-                    await aiosmtplib.send(
-                        message,
-                        hostname=cs.REPORTS_SMTP_HOST,
-                        port=cs.REPORTS_SMTP_PORT,
-                        username=cs.REPORTS_SMTP_LOGIN,
-                        password=cs.REPORTS_SMTP_PASSWORD,
-                        use_tls=False,
-                        start_tls=True
-                    )
+            # stored before a restart, only pending deliveries are left
+            if not self.__outbox.contains(self.alias, period):
+                data = await self.__dbconnector_ws.callproc('rep_consumables', rows=-1, values=[from_day])
+                content = await self.__renderer.render(f'{cs.RESOURCES}/ampp/{self.__template}',
+                                                       rows=(2, [[val[key] for key in INCOMINGS_COLUMNS] for val in data]))
+                filename = f"{cs.AMPP_PARKING_ID}_неделя_{weeknum}_доходность.xlsx"
+                message = MIMEMultipart()
+                message["From"] = cs.REPORTS_SMTP_ADDRESS
+                message["Subject"] = f'Доходность {cs.AMPP_PARKING_ID}'
+                plain_text_message = MIMEText(f"Неделя:{weeknum}\nМесяц:{from_day.month}\nГод:{from_day.year}\n", "plain", "utf-8")
+                message.attach(plain_text_message)
+                attachment = MIMEApplication(content, _subtype="xlsx")
+                attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+                message.attach(attachment)
+                self.__outbox.enqueue(self.alias, period, message, self.__addresses)
         except:
-            raise
+            await self.__logger.exception({'module': self.name, 'msg': f'Report {period} not queued'})
+            return
+        await self._drain()
+
+    async def _drain(self):
+        results = await self.__outbox.drain(self.alias)
+        for result in results:
+            if result['status'] != 'sent':
+                await self.__logger.error({'module': self.name, 'delivery': result})
+
+    def register(self, supervisor):
+        supervisor.add_job(self.alias, self.__schedule, self._process)
+        supervisor.add_job(f'{self.alias}_outbox', self.__drain_schedule, self._drain)
 
     async def _dispatch(self):
-        while not self.eventsignal:
-            if datetime.today().weekday() == 0 and datetime.now().hour > 0 and datetime.now().hour < 3:
-                await self._process()
-                await asyncio.sleep(24*60*60)
+        # metrics of this worker process, see Application
+        if self.__exporter is not None:
+            await self.__exporter.start()
+        self.__supervisor = CronSupervisor(self.__logger)
+        self.register(self.__supervisor)
+        await self.__supervisor.run()
 
     async def _signal_cleanup(self):
         await self.__logger.warning({'module': self.name, 'msg': 'Shutting down'})
         await self.__dbconnector_is.callproc('cmiu_processes_upd', rows=0, values=[self.name, 0, 0, datetime.now()])
         closing_tasks = []
         closing_tasks.append(self.__dbconnector_is.disconnect())
-        closing_tasks.append(self.__amqpconnector.disconnect())
         closing_tasks.append(self.__logger.shutdown())
         await asyncio.gather(*closing_tasks, return_exceptions=True)
+        self.__renderer.shutdown()
+        self.__outbox.close()
+        await self.__mailer.close()
 
     async def _signal_handler(self, signal):
         # stop while loop coroutine
         self.eventsignal = True
+        if self.__supervisor is not None:
+            self.__supervisor.stop()
         tasks = [task for task in asyncio.all_tasks(self.eventloop) if task is not
                  asyncio.tasks.current_task()]
         for t in tasks:
             t.cancel()
-        asyncio.ensure_future(self._signal_cleanup())
+        await asyncio.gather(self._signal_cleanup(), return_exceptions=True)
         # perform eventloop shutdown
         try:
             self.eventloop.stop()
@@ -148,6 +168,7 @@ class ConsumablesNotifier:
         os._exit(0)
 
     def run(self):
+        setproctitle('rep-consumables')
         # use own event loop
         self.eventloop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.eventloop)
@@ -163,6 +184,3 @@ class ConsumablesNotifier:
         except asyncio.CancelledError:
             pass
 
-
-reporter = IncomingsSender()
-reporter.run()
@@ -2,33 +2,83 @@ import asyncio
 import functools
 import os
 import signal
-from datetime import date, datetime, timedelta
+from datetime import datetime
 from email.message import EmailMessage
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from pathlib import Path
 
-import aiosmtplib
-import openpyxl
 import pycron
 import toml
 
 import configuration.settings as cs
-from utils.asyncsql import AsyncDBPool
-from utils.asynclog import AsyncLogger
+from modules.reports.common.cron import CronSupervisor
+from modules.reports.common.dbpool import InstrumentedDBPool
+from modules.reports.common.render import RenderExecutor
+from modules.reports.common.sites import SiteRegistry, sum_records
+from modules.reports.common.logger import shared_logger
+from modules.reports.notifier.mailer import Mailer, SMTPPool
+from modules.reports.notifier.outbox import Outbox
+from modules.reports.notifier.ranged import RangedQuery, period_window
 
 from setproctitle import setproctitle
 from sdnotify import SystemdNotifier
 
 
+INCOMINGS_COLUMNS = (
+    "DayWeek",
+    "totalEntries",
+    "totalExits",
+    "totalPayments",
+    "cashIncomings",
+    "cashlessIncomings",
+    "mobileIncomings",
+    "totalIncomings",
+    "lostTickets",
+    "totalExemptions",
+)
+
+
+def incomings_rows(data):
+    return (2, [[val[key] for key in INCOMINGS_COLUMNS] for val in data])
+
+
+# day rows of several parkings summed per day, windows are the same
+def combined_days(data):
+    return [
+        {"DayWeek": days[0]["DayWeek"], **sum_records(days, INCOMINGS_COLUMNS[1:])}
+        for days in zip(*data)
+    ]
+
+
 class IncomingsNotifier:
-    def __init__(self):
+    # pools, logger and renderer are shared when hosted by single process Application
+    def __init__(
+        self,
+        dbconnector_ws=None,
+        dbconnector_is=None,
+        logger=None,
+        renderer=None,
+        outbox=None,
+        exporter=None,
+        sites=None,
+    ):
         self.__eventsignal = False
         self.__eventloop = None
-        self.__dbconnector_ws = None
-        self.__dbconnector_is = None
+        self.__logger = logger
+        self.__exporter = exporter
+        self.__dbconnector_ws = dbconnector_ws
+        self.__dbconnector_is = dbconnector_is
+        self.__renderer = renderer
+        self.__supervisor = None
+        self.__mailer = None
+        self.__outbox = outbox
+        self.__sites = sites
+        self.__queries = {}
         self.__addresses = []
+        self.name = "IncomingsNotifier"
+        self.type = "notify"
+        self.alias = "incomings"
 
     @property
     def evntloop(self):
@@ -45,109 +95,132 @@ class IncomingsNotifier:
     async def _initialize(self):
         sd_notifier = SystemdNotifier()
         configuration = toml.load(cs.CONFIG_FILE)
-        self.__logger = AsyncLogger(f"{cs.LOG_PATH}/reports.log")
-        self.__dbconnector_is = AsyncDBPool(
-            host=configuration["wisepark"]["rdbs"]["host"],
-            port=configuration["wisepark"]["rdbs"]["port"],
-            login=configuration["wisepark"]["rdbs"]["login"],
-            password=configuration["wisepark"]["rdbs"]["password"],
-            database=configuration["wisepark"]["rdbs"]["database"],
-        )
-        self.__dbconnector_ws = AsyncDBPool(
-            host=configuration["integration"]["rdbs"]["host"],
-            port=configuration["integration"]["rdbs"]["port"],
-            login=configuration["integration"]["rdbs"]["login"],
-            password=configuration["integration"]["rdbs"]["password"],
-            database=configuration["integration"]["rdbs"]["database"],
-        )
-
+        if self.__logger is None:
+            self.__logger = await shared_logger().getlogger()
         connections_tasks = []
-        connections_tasks.append(self.__dbconnector_is.connect())
-        connections_tasks.append(self.__dbconnector_ws.connect())
+        if self.__dbconnector_ws is None:
+            self.__dbconnector_ws = InstrumentedDBPool.from_configuration(configuration, "wisepark")
+            connections_tasks.append(self.__dbconnector_ws.connect())
+        if self.__dbconnector_is is None:
+            self.__dbconnector_is = InstrumentedDBPool.from_configuration(configuration, "integration")
+            connections_tasks.append(self.__dbconnector_is.connect())
+        # the WisePark pool above is the primary parking's one
+        if self.__sites is None:
+            self.__sites = SiteRegistry.from_configuration(
+                configuration, InstrumentedDBPool, dbconnector=self.__dbconnector_ws
+            )
+            connections_tasks.append(self.__sites.connect())
+        if self.__renderer is None:
+            # renders once a period, one worker spawned per render
+            self.__renderer = RenderExecutor(
+                configuration["reports"].get("render", {}).get("notifier_workers", 1),
+                persistent=False,
+            )
         await asyncio.gather(*connections_tasks)
         reports_settings = toml.load(cs.REPORTS_FILE)
         self.__schedule = reports_settings["notify"]["incomings"]["schedule"]
         self.__addresses = reports_settings["notify"]["incomings"]["addresses"]
-        self.__template = reports_settings["noitify"]["incomings"]["template"]
+        self.__template = reports_settings["notify"]["incomings"]["template"]
+        # week, month or quarter
+        self.__period = reports_settings["notify"]["incomings"].get("period", "week")
+        # parking ids or ["all"], one workbook with a sheet per parking or
+        # a summary of them
+        self.__report_sites = self.__sites.select(
+            reports_settings["notify"]["incomings"].get("sites", [])
+        )
+        self.__layout = reports_settings["notify"]["incomings"].get("layout", "sheets")
+        for site in self.__report_sites:
+            self.__queries[site.id] = RangedQuery(
+                site.dbconnector,
+                "rep_incomings",
+                concurrency=reports_settings["notify"]["incomings"].get("concurrency", 4),
+                logger=self.__logger,
+            )
+        smtp = configuration["reports"]["smtp"]
+        self.__mailer = Mailer(
+            SMTPPool.from_settings(smtp, size=smtp.get("pool", 2)),
+            cs.REPORTS_SMTP_ADDRESS,
+            concurrency=smtp.get("concurrency", 4),
+            retries=smtp.get("retries", 3),
+        )
+        outbox = reports_settings["notify"].get("outbox", {})
+        self.__drain_schedule = outbox.get("schedule", "*/5 * * * *")
+        if self.__outbox is None:
+            self.__outbox = Outbox(
+                outbox.get("path", f"{cs.TEMPORARY_DIR}/reports_outbox.db"),
+                self.__mailer,
+                max_attempts=outbox.get("attempts", 10),
+                backoff=outbox.get("backoff", 60),
+                retention=outbox.get("retention", 30 * 24 * 60 * 60),
+            )
         return self
 
     async def _process(self):
+        from_day, to_day, period = period_window(self.__period)
+        weeknum = from_day.isocalendar()[1]
+        if self.__period == "week":
+            label = f"неделя_{weeknum}"
+            text = f"Неделя:{weeknum}\nМесяц:{from_day.month}\nГод:{from_day.year}\n"
+        elif self.__period == "month":
+            label = f"месяц_{from_day.month}"
+            text = f"Месяц:{from_day.month}\nГод:{from_day.year}\n"
+        else:
+            quarter = (from_day.month - 1) // 3 + 1
+            label = f"квартал_{quarter}"
+            text = f"Квартал:{quarter}\nГод:{from_day.year}\n"
         try:
-            today = date.today()
-            from_day = today - timedelta(days=today.weekday(), weeks=1)
-            weeknum = from_day.isocalendar()[1]
-            dates = [from_day + timedelta(days=d) for d in range(7)]
-            tasks = []
-            for d in dates:
-                tasks.append(
-                    self.__dbconnector_ws.callproc("rep_incomings", rows=1, values=[d])
+            # stored before a restart, only pending deliveries are left
+            if not self.__outbox.contains(self.alias, period):
+                sites = self.__report_sites
+                data = await self.__sites.gather(
+                    lambda site: self.__queries[site.id].fetch(from_day, to_day), sites
                 )
-            data = await asyncio.gather(*tasks)
-            wb = openpyxl.load_workbook(f"{cs.RESOURCES}/ampp/incomings_report.xlsx")
-            ws = wb.active
-            ws.title = cs.AMPP_PARKING_ADDRESS
-            rows = [row for row in ws.iter_rows(min_row=2, max_row=8)]
-            for row, val in zip(rows, data):
-                ws.cell(column=1, row=row[0].row).value = val["DayWeek"]
-                ws.cell(column=2, row=row[0].row).value = val["totalEntries"]
-                ws.cell(column=3, row=row[0].row).value = val["totalExits"]
-                ws.cell(column=4, row=row[0].row).value = val["totalPayments"]
-                ws.cell(column=5, row=row[0].row).value = val["cashIncomings"]
-                ws.cell(column=6, row=row[0].row).value = val["cashlessIncomings"]
-                ws.cell(column=7, row=row[0].row).value = val["mobileIncomings"]
-                ws.cell(column=8, row=row[0].row).value = val["totalIncomings"]
-                ws.cell(column=9, row=row[0].row).value = val["lostTickets"]
-                ws.cell(column=10, row=row[0].row).value = val["totalExemptions"]
-            file = f"{cs.AMPP_PARKING_ID}_неделя_{weeknum}_доходность.xlsx"
-            wb.save(file)
-            configuration = toml.load(cs.CONFIG_FILE)
-            settings = toml.load(cs.REPORTS_FILE)
-            for address in settings["notify"]["incomings"]["addresses"]:
-                # send data
+                if len(sites) == 1:
+                    sheets = [{"rows": incomings_rows(data[0]), "title": sites[0].address}]
+                elif self.__layout == "summary":
+                    sheets = [{"rows": incomings_rows(combined_days(data)), "title": "Итого"}]
+                else:
+                    sheets = [
+                        {"rows": incomings_rows(site_data), "title": str(site.id)}
+                        for site, site_data in zip(sites, data)
+                    ]
+                content = await self.__renderer.render(
+                    f"{cs.RESOURCES}/ampp/incomings_report.xlsx", sheets=sheets
+                )
+                ids = [str(site.id) for site in sites]
+                site_label = ids[0] if len(ids) == 1 else "sites"
+                filename = f"{site_label}_{label}_доходность.xlsx"
                 message = MIMEMultipart()
                 message["From"] = cs.REPORTS_SMTP_ADDRESS
-                message["To"] = address
-                message["Subject"] = f"Доходность {configuration['ampp']['id']}"
-                plain_text_message = MIMEText(
-                    f"Неделя:{weeknum}\nМесяц:{from_day.month}\nГод:{from_day.year}\n",
-                    "plain",
-                    "utf-8",
-                )
+                message["Subject"] = f"Доходность {', '.join(ids)}"
+                plain_text_message = MIMEText(text, "plain", "utf-8")
                 message.attach(plain_text_message)
-                fp = open(file, "rb")
-                attachment = MIMEApplication(fp.read(), _subtype="xlsx")
-                fp.close()
-                filename = f"{Path(file).name}"
-                attachment.add_header(
-                    "Content-Disposition", "attachment", filename=filename
-                )
+                attachment = MIMEApplication(content, _subtype="xlsx")
+                attachment.add_header("Content-Disposition", "attachment", filename=filename)
                 message.attach(attachment)
-                plain_text_message = MIMEText(
-                    "\nАвтоматизированная система генерации и отправки отчетов"
-                )
-                await aiosmtplib.send(
-                    message,
-                    hostname=configuration["reports"]["smtp"]["host"],
-                    port=configuration["reports"]["smtp"]["port"],
-                    username=configuration["reports"]["smtp"]["login"],
-                    password=configuration["reports"]["smtp"]["password"],
-                    use_tls=configuration["reports"]["smtp"]["use_tls"],
-                    start_tls=configuration["reports"]["smtp"]["start_tls"],
-                )
-                os.remove(filename)
+                self.__outbox.enqueue(self.alias, period, message, self.__addresses)
         except:
-            pass
+            await self.__logger.exception({"module": self.name, "msg": f"Report {period} not queued"})
+            return
+        await self._drain()
+
+    async def _drain(self):
+        results = await self.__outbox.drain(self.alias)
+        for result in results:
+            if result["status"] != "sent":
+                await self.__logger.error({"module": self.name, "delivery": result})
+
+    def register(self, supervisor):
+        supervisor.add_job(self.alias, self.__schedule, self._process)
+        supervisor.add_job(f"{self.alias}_outbox", self.__drain_schedule, self._drain)
 
     async def _dispatch(self):
-        while not self.eventsignal:
-            settings = toml.load(cs.REPORTS_FILE)
-            if (
-                datetime.today().weekday() == 0
-                and datetime.now().hour > 0
-                and datetime.now().hour < 3
-            ):
-                await self._process()
-                await asyncio.sleep(24 * 60 * 60)
+        # metrics of this worker process, see Application
+        if self.__exporter is not None:
+            await self.__exporter.start()
+        self.__supervisor = CronSupervisor(self.__logger)
+        self.register(self.__supervisor)
+        await self.__supervisor.run()
 
     async def _signal_cleanup(self):
         await self.__logger.warning({"module": self.name, "msg": "Shutting down"})
@@ -156,13 +229,18 @@ class IncomingsNotifier:
         )
         closing_tasks = []
         closing_tasks.append(self.__dbconnector_is.disconnect())
-        closing_tasks.append(self.__amqpconnector.disconnect())
+        closing_tasks.append(self.__sites.disconnect())
         closing_tasks.append(self.__logger.shutdown())
         await asyncio.gather(*closing_tasks, return_exceptions=True)
+        self.__renderer.shutdown()
+        self.__outbox.close()
+        await self.__mailer.close()
 
     async def _signal_handler(self, signal):
         # stop while loop coroutine
         self.eventsignal = True
+        if self.__supervisor is not None:
+            self.__supervisor.stop()
         tasks = [
             task
             for task in asyncio.all_tasks(self.eventloop)
@@ -170,7 +248,7 @@ class IncomingsNotifier:
         ]
         for t in tasks:
             t.cancel()
-        asyncio.ensure_future(self._signal_cleanup())
+        await asyncio.gather(self._signal_cleanup(), return_exceptions=True)
         # perform eventloop shutdown
         try:
             self.eventloop.stop()
@@ -181,6 +259,7 @@ class IncomingsNotifier:
         os._exit(0)
 
     def run(self):
+        setproctitle("rep-incomings")
         # use own event loop
         self.eventloop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.eventloop)
@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import aiosmtplib
+
+from modules.reports.common.metrics import REGISTRY
+
+
+SMTP_SECONDS = REGISTRY.histogram('reports_smtp_send_seconds', 'SMTP send latency per attempt', ('status',))
+SMTP_DELIVERIES = REGISTRY.counter('reports_smtp_deliveries_total', 'Recipient deliveries by final status', ('status',))
+
+
+class SMTPPool:
+    """
+    Small pool of persistent SMTP connections, opened on demand and
+    reconnected when the server drops them.
+    """
+
+    def __init__(self, hostname, port, username=None, password=None, use_tls=False, start_tls=False, size=2):
+        self.__settings = {'hostname': hostname, 'port': port, 'username': username, 'password': password,
+                           'use_tls': use_tls, 'start_tls': start_tls}
+        self.__size = size
+        self.__clients = None
+
+    @classmethod
+    def from_settings(cls, smtp, size=2):
+        return cls(hostname=smtp['host'], port=smtp['port'], username=smtp.get('login'), password=smtp.get('password'),
+                   use_tls=smtp.get('use_tls', False), start_tls=smtp.get('start_tls', False), size=size)
+
+    def _ensure(self):
+        if self.__clients is None:
+            self.__clients = asyncio.Queue()
+            for _ in range(self.__size):
+                self.__clients.put_nowait(aiosmtplib.SMTP(hostname=self.__settings['hostname'],
+                                                          port=self.__settings['port'],
+                                                          use_tls=self.__settings['use_tls'],
+                                                          start_tls=self.__settings['start_tls']))
+
+    async def sendmail(self, sender, recipients, data):
+        self._ensure()
+        clients = self.__clients
+        client = await clients.get()
+        try:
+            if not client.is_connected:
+                try:
+                    await client.connect()
+                    if self.__settings['username']:
+                        await client.login(self.__settings['username'], self.__settings['password'])
+                except BaseException:
+                    # not authenticated, the next send reconnects
+                    client.close()
+                    raise
+            return await client.sendmail(sender, recipients, data)
+        except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+            client.close()
+            raise
+        finally:
+            clients.put_nowait(client)
+
+    async def close(self):
+        if self.__clients is None:
+            return
+        while not self.__clients.empty():
+            client = self.__clients.get_nowait()
+            if client.is_connected:
+                try:
+                    await client.quit()
+                except aiosmtplib.SMTPException:
+                    client.close()
+        self.__clients = None
+
+
+class Mailer:
+    """
+    Sends one serialized message to many recipients concurrently.
+
+    The message is rendered to bytes once without a To header, every
+    recipient gets the shared bytes prefixed with its own To header.
+    Each recipient is retried with exponential backoff on its own.
+    """
+
+    def __init__(self, pool, sender, concurrency=4, retries=3, backoff=2.0):
+        self.__pool = pool
+        self.__sender = sender
+        self.__concurrency = concurrency
+        self.__retries = retries
+        self.__backoff = backoff
+
+    async def _deliver(self, data, address, semaphore):
+        result = {'address': address, 'status': 'failed', 'attempts': 0, 'error': None, 'ts': None}
+        payload = f'To: {address}\r\n'.encode() + data
+        async with semaphore:
+            for attempt in range(self.__retries + 1):
+                result['attempts'] = attempt + 1
+                started = time.perf_counter()
+                try:
+                    await self.__pool.sendmail(self.__sender, [address], payload)
+                    SMTP_SECONDS.observe(time.perf_counter() - started, status='sent')
+                    result['status'] = 'sent'
+                    result['error'] = None
+                    break
+                except (aiosmtplib.SMTPException, OSError) as e:
+                    SMTP_SECONDS.observe(time.perf_counter() - started, status='failed')
+                    result['error'] = repr(e)
+                    if attempt < self.__retries:
+                        await asyncio.sleep(self.__backoff * 2 ** attempt)
+        result['ts'] = time.time()
+        SMTP_DELIVERIES.inc(status=result['status'])
+        return result
+
+    async def send(self, message, addresses):
+        """
+        Returns delivery records: address, status (sent/failed), attempts, error, ts.
+        """
+        del message['To']
+        data = message.as_bytes(policy=message.policy.clone(linesep='\r\n'))
+        return await self.send_bytes(data, addresses)
+
+    async def send_bytes(self, data, addresses):
+        """
+        Same as send() for a message already serialized without To header.
+        """
+        semaphore = asyncio.Semaphore(self.__concurrency)
+        return await asyncio.gather(*[self._deliver(data, address, semaphore)
+                                      for address in addresses if len(address) > 0])
+
+    async def close(self):
+        # connections stay open between sends, closed on shutdown
+        await self.__pool.close()
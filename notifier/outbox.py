@@ -0,0 +1,123 @@
+import asyncio
+import sqlite3
+import time
+
+
+class Outbox:
+    """
+    Durable outbox of rendered notifier messages in SQLite.
+
+    A message is stored once per (report, period) before sending, every
+    recipient is a delivery row deduplicated by (report, period, recipient).
+    drain() sends due deliveries and reschedules failed ones with
+    exponential backoff, so pending mail survives SMTP outages and restarts.
+    Drains of one report do not overlap, a delivery is sent by one drain.
+    Payloads older than retention seconds without pending deliveries are
+    pruned, their (report, period) row is kept so it is not queued again.
+    """
+
+    def __init__(self, path, mailer, max_attempts=10, backoff=60, max_backoff=6 * 60 * 60,
+                 retention=30 * 24 * 60 * 60):
+        self.__mailer = mailer
+        self.__max_attempts = max_attempts
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__retention = retention
+        self.__locks = {}
+        self.__connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.__connection.executescript('''
+            CREATE TABLE IF NOT EXISTS payloads (
+                id INTEGER PRIMARY KEY,
+                report TEXT NOT NULL,
+                period TEXT NOT NULL,
+                data BLOB NOT NULL,
+                created REAL NOT NULL,
+                UNIQUE (report, period)
+            );
+            CREATE TABLE IF NOT EXISTS deliveries (
+                id INTEGER PRIMARY KEY,
+                payload_id INTEGER NOT NULL REFERENCES payloads(id),
+                report TEXT NOT NULL,
+                period TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                error TEXT,
+                sent REAL,
+                UNIQUE (report, period, recipient)
+            );
+        ''')
+
+    def contains(self, report, period):
+        row = self.__connection.execute('SELECT 1 FROM payloads WHERE report = ? AND period = ?',
+                                        (report, period)).fetchone()
+        return row is not None
+
+    def enqueue(self, report, period, message, addresses):
+        del message['To']
+        data = message.as_bytes(policy=message.policy.clone(linesep='\r\n'))
+        now = time.time()
+        with self.__connection:
+            self.__connection.execute('BEGIN')
+            self.__connection.execute('INSERT OR IGNORE INTO payloads (report, period, data, created) VALUES (?, ?, ?, ?)',
+                                      (report, period, data, now))
+            payload_id = self.__connection.execute('SELECT id FROM payloads WHERE report = ? AND period = ?',
+                                                   (report, period)).fetchone()[0]
+            self.__connection.executemany('INSERT OR IGNORE INTO deliveries (payload_id, report, period, recipient, next_attempt) '
+                                          'VALUES (?, ?, ?, ?, ?)',
+                                          [(payload_id, report, period, address, now) for address in addresses if len(address) > 0])
+
+    async def drain(self, report):
+        """
+        Sends due deliveries of the report, returns their delivery records.
+        """
+        # the scheduled drain and the one after _process may overlap
+        lock = self.__locks.setdefault(report, asyncio.Lock())
+        async with lock:
+            results = await self._drain(report)
+            self.prune(report)
+            return results
+
+    async def _drain(self, report):
+        now = time.time()
+        due = self.__connection.execute("SELECT id, payload_id, recipient, attempts FROM deliveries "
+                                        "WHERE report = ? AND status = 'pending' AND next_attempt <= ? ORDER BY payload_id",
+                                        (report, now)).fetchall()
+        grouped = {}
+        for delivery_id, payload_id, recipient, attempts in due:
+            grouped.setdefault(payload_id, {})[recipient] = (delivery_id, attempts)
+        results = []
+        for payload_id, recipients in grouped.items():
+            data = self.__connection.execute('SELECT data FROM payloads WHERE id = ?', (payload_id,)).fetchone()[0]
+            for result in await self.__mailer.send_bytes(data, list(recipients)):
+                delivery_id, attempts = recipients[result['address']]
+                attempts += 1
+                if result['status'] == 'sent':
+                    self.__connection.execute("UPDATE deliveries SET status = 'sent', attempts = ?, error = NULL, sent = ? WHERE id = ?",
+                                              (attempts, result['ts'], delivery_id))
+                else:
+                    status = 'failed' if attempts >= self.__max_attempts else 'pending'
+                    delay = min(self.__backoff * 2 ** (attempts - 1), self.__max_backoff)
+                    self.__connection.execute('UPDATE deliveries SET status = ?, attempts = ?, error = ?, next_attempt = ? WHERE id = ?',
+                                              (status, attempts, result['error'], time.time() + delay, delivery_id))
+                results.append(result)
+        return results
+
+    def prune(self, report):
+        """
+        Drops the data and deliveries of old payloads whose deliveries are all sent or failed.
+        """
+        expired = time.time() - self.__retention
+        with self.__connection:
+            self.__connection.execute('BEGIN')
+            payloads = [row[0] for row in self.__connection.execute(
+                "SELECT id FROM payloads p WHERE report = ? AND created < ? AND length(data) > 0 AND NOT EXISTS "
+                "(SELECT 1 FROM deliveries d WHERE d.payload_id = p.id AND d.status = 'pending')",
+                (report, expired))]
+            self.__connection.executemany('DELETE FROM deliveries WHERE payload_id = ?', [(i,) for i in payloads])
+            self.__connection.executemany("UPDATE payloads SET data = X'' WHERE id = ?", [(i,) for i in payloads])
+        return len(payloads)
+
+    def close(self):
+        self.__connection.close()
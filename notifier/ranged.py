@@ -0,0 +1,66 @@
+import asyncio
+from datetime import date, datetime, timedelta
+
+from modules.reports.common.dbpool import procedure_missing
+
+
+def period_window(period, today=None):
+    """
+    Returns (first day, last day, label) of the last complete week, month or quarter.
+    """
+    today = today or date.today()
+    if period == 'week':
+        start = today - timedelta(days=today.weekday(), weeks=1)
+        stop = start + timedelta(days=6)
+        year, week, _ = start.isocalendar()
+        return start, stop, f'{year}-W{week:02d}'
+    if period == 'month':
+        stop = today.replace(day=1) - timedelta(days=1)
+        return stop.replace(day=1), stop, f'{stop.year}-{stop.month:02d}'
+    if period == 'quarter':
+        first_month = (today.month - 1) // 3 * 3 + 1
+        stop = today.replace(month=first_month, day=1) - timedelta(days=1)
+        start = stop.replace(month=stop.month - 2, day=1)
+        return start, stop, f'{stop.year}-Q{(stop.month - 1) // 3 + 1}'
+    raise ValueError(f'Unknown period {period}')
+
+
+class RangedQuery:
+    """
+    Per-day rows of a report procedure for any date window.
+
+    Calls <procedure>_range(start, stop) once, the procedure returns a row
+    per day with a `date` column. On DB schemas without it falls back to
+    per-day <procedure>(day) calls, at most `concurrency` at a time.
+    """
+
+    def __init__(self, dbconnector, procedure, concurrency=4, logger=None):
+        self.__dbconnector = dbconnector
+        self.__procedure = procedure
+        self.__concurrency = concurrency
+        self.__logger = logger
+        self.__ranged = True
+
+    @property
+    def ranged(self):
+        return self.__ranged
+
+    async def _fetch_days(self, days):
+        semaphore = asyncio.Semaphore(self.__concurrency)
+
+        async def fetch(day):
+            async with semaphore:
+                return await self.__dbconnector.callproc(self.__procedure, rows=1, values=[day])
+        return await asyncio.gather(*[fetch(d) for d in days])
+
+    async def fetch(self, start, stop):
+        if self.__ranged:
+            try:
+                data = await self.__dbconnector.callproc(f'{self.__procedure}_range', rows=-1, values=[start, stop])
+                return sorted(data, key=lambda row: row['date'].date() if isinstance(row['date'], datetime) else row['date'])
+            except Exception as e:
+                if procedure_missing(e):
+                    self.__ranged = False
+                if self.__logger is not None:
+                    await self.__logger.warning({'module': self.__procedure, 'msg': f'Ranged query failed, using per day queries: {e!r}'})
+        return await self._fetch_days([start + timedelta(days=d) for d in range((stop - start).days + 1)])
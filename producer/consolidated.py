@@ -0,0 +1,213 @@
+import asyncio
+import functools
+import signal
+import sys
+from datetime import date, timedelta
+
+import uvloop
+from setproctitle import setproctitle
+import toml
+
+import configuration.settings as cs
+from modules.reports.common.cron import CronSupervisor
+from modules.reports.common.dbpool import InstrumentedDBPool
+from modules.reports.common.logger import shared_logger
+from modules.reports.producer.scheduler import UnitScheduler
+
+
+CONSOLIDATED_METRICS = (
+    'entries',
+    'payments',
+    'exits',
+    'unpaidExits',
+    'lostTickets',
+    'lostTicketSum',
+    'totalPayments',
+    'cashPayments',
+    'cardPayments',
+    'troikaPayments',
+    'otherPayments',
+)
+
+
+class ConsolidatedRollupProducer:
+    """
+    Keeps daily totals of the consolidated report in the integration DB
+    (rep_consolidated_ins), so a consolidated report of any range sums
+    closed days from the rollup and only today is computed live.
+    """
+
+    # pools and logger are shared when hosted by single process Application
+    def __init__(self, dbconnector_ws=None, dbconnector_is=None, logger=None, exporter=None):
+        self.__logger: object = logger
+        self.__exporter: object = exporter
+        self.__dbconnector_ws: object = dbconnector_ws
+        self.__dbconnector_is: object = dbconnector_is
+        self.__eventsignal = False
+        self.__eventloop = None
+        self.name = 'ConsolidatedDataMiner'
+        self.type = 'gather'
+        self.alias = 'consolidated'
+        self.__schedule = None
+        self.__backfill = 365
+        self.__scheduler = None
+        self.__supervisor = None
+
+    @property
+    def eventloop(self):
+        return self.__eventloop
+
+    @eventloop.setter
+    def eventloop(self, value):
+        self.__eventloop = value
+
+    @property
+    def eventsignal(self):
+        return self.__eventsignal
+
+    @eventsignal.setter
+    def eventsignal(self, value):
+        self.__eventsignal = value
+
+    @staticmethod
+    def _record(data_out: dict, day: date):
+        data_out = data_out or {}
+        return [day] + [data_out.get(key) or 0 for key in CONSOLIDATED_METRICS]
+
+    # one closed day from raw transactions into the rollup table
+    async def _fetch(self, day: date):
+        period = day.strftime('%Y-%m-%d 00:00:00')
+        async with self.__scheduler.quota('wisepark'):
+            data_out = await self.__dbconnector_ws.callproc('ampp_consolidatedrep_get', rows=1, values=[period, period])
+        async with self.__scheduler.quota('integration'):
+            await self.__dbconnector_is.callproc('rep_consolidated_ins', rows=0, values=self._record(data_out, day))
+
+    # rolls up days from the last stored one (recomputed, it may have been
+    # stored before it was closed) up to yesterday
+    async def _rollup(self):
+        # finishes the journaled run left by a crash or failed days first
+        pending = self.__scheduler.pending()
+        if pending is not None:
+            run_id, params = pending
+            await self.__logger.info({'module': self.name, 'msg': 'Resuming run', 'run': run_id})
+            failed = await self._run([date.fromisoformat(d) for d in params['dates']], run_id)
+            if self.__scheduler.pending() is not None:
+                return
+            if failed:
+                await self.__logger.warning({'module': self.name, 'msg': 'Run dropped after resumes, failed days are not retried',
+                                             'run': run_id, 'units': sorted(failed)})
+        last_report = await self.__dbconnector_is.callproc('rep_consolidated_last_get', rows=1, values=[])
+        today = date.today()
+        if last_report is None or last_report['repDate'] is None:
+            first_day = today - timedelta(days=self.__backfill)
+        else:
+            first_day = last_report['repDate']
+        dates = [first_day + timedelta(days=x) for x in range((today - first_day).days)]
+        if not dates:
+            return
+        await self._run(dates)
+
+    # returns units failed after all retries
+    async def _run(self, dates: list, run_id=None):
+        units = [(str(d), (d,)) for d in dates]
+        params = {'dates': [str(d) for d in dates]}
+        failed = await self.__scheduler.run(run_id or f'{dates[0]}:{dates[-1]}', units, self._fetch, params)
+        for unit, error in failed.items():
+            await self.__logger.error({'module': self.name, 'unit': unit, 'error': repr(error)})
+        return failed
+
+    async def _initialize(self):
+        try:
+            configuration = toml.load(cs.CONFIG_FILE)
+            reports_settings = toml.load(cs.REPORTS_FILE)
+            settings = reports_settings['gather'].get(self.alias, {})
+            self.__schedule = settings.get('schedule', '10 0 * * *')
+            self.__backfill = settings.get('backfill', 365)
+            scheduling = settings.get('scheduling', {})
+            self.__scheduler = UnitScheduler(limit=scheduling.get('limit', 4),
+                                             retries=scheduling.get('retries', 3),
+                                             backoff=scheduling.get('backoff', 1.0),
+                                             journal=f'{cs.TEMPORARY_DIR}/{self.alias}_units.journal',
+                                             resumes=scheduling.get('resumes', 3))
+            self.__scheduler.add_quota('wisepark', scheduling.get('wisepark', 2))
+            self.__scheduler.add_quota('integration', scheduling.get('integration', 2))
+            if self.__logger is None:
+                self.__logger = await shared_logger().getlogger()
+            await self.__logger.info({'module': self.name, 'msg': 'Starting...'})
+            connection_tasks = []
+            if self.__dbconnector_is is None:
+                self.__dbconnector_is = InstrumentedDBPool.from_configuration(configuration, 'integration')
+                connection_tasks.append(self.__dbconnector_is.connect())
+            if self.__dbconnector_ws is None:
+                self.__dbconnector_ws = InstrumentedDBPool.from_configuration(configuration, 'wisepark')
+                connection_tasks.append(self.__dbconnector_ws.connect())
+            await asyncio.gather(*connection_tasks)
+            await self._rollup()
+            await self.__logger.info({'module': self.name, 'msg': 'Started'})
+            return self
+        except:
+            if self.__logger is not None:
+                await self.__logger.exception({'module': self.name, 'msg': 'Initialization failed'})
+            sys.exit(1)
+
+    async def _tick(self):
+        try:
+            await self._rollup()
+        except:
+            await self.__logger.exception({'module': self.name})
+
+    def register(self, supervisor):
+        supervisor.add_job(self.alias, self.__schedule, self._tick)
+
+    async def _dispatch(self):
+        # metrics of this worker process, see Application
+        if self.__exporter is not None:
+            await self.__exporter.start()
+        self.__supervisor = CronSupervisor(self.__logger)
+        self.register(self.__supervisor)
+        await self.__supervisor.run()
+
+    async def _signal_cleanup(self):
+        await self.__logger.warning({'module': self.name, 'msg': 'Shutting down'})
+        closing_tasks = []
+        closing_tasks.append(self.__dbconnector_is.disconnect())
+        closing_tasks.append(self.__dbconnector_ws.disconnect())
+        closing_tasks.append(self.__logger.shutdown())
+        await asyncio.gather(*closing_tasks, return_exceptions=True)
+
+    async def _signal_handler(self, signal):
+        # stop while loop coroutine
+        self.eventsignal = True
+        if self.__supervisor is not None:
+            self.__supervisor.stop()
+        tasks = [task for task in asyncio.all_tasks(self.eventloop) if task is not
+                 asyncio.tasks.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(self._signal_cleanup(), return_exceptions=True)
+        # perform eventloop shutdown
+        try:
+            self.eventloop.stop()
+            self.eventloop.close()
+        except:
+            pass
+        # close process
+        sys.exit(0)
+
+    def run(self):
+        setproctitle('rep-consolidated')
+        # use own loop
+        uvloop.install()
+        self.eventloop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.eventloop)
+        signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+        # add signal handler to loop
+        for s in signals:
+            self.eventloop.add_signal_handler(s, functools.partial(asyncio.ensure_future,
+                                                                   self._signal_handler(s)))
+        # try-except statement for signals
+        try:
+            self.eventloop.run_until_complete(self._initialize())
+            self.eventloop.run_until_complete(self._dispatch())
+        except asyncio.CancelledError:
+            pass
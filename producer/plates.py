@@ -11,22 +11,37 @@ from setproctitle import setproctitle
 import toml
 
 import configuration.settings as cs
-from utils.asyncsql import AsyncDBPool
-from utils.asynclog import AsyncLogger
-import pycron
+from modules.reports.common.cron import CronSupervisor
+from modules.reports.common.dbpool import InstrumentedDBPool, procedure_missing
+from modules.reports.common.metrics import REGISTRY
+from modules.reports.common.logger import shared_logger
+from modules.reports.producer.scheduler import UnitScheduler
+
+
+PLATES_UNITS = REGISTRY.counter('reports_plates_units_total', 'Device x date units processed', ('path',))
+PLATES_CYCLE_SECONDS = REGISTRY.histogram('reports_plates_cycle_seconds', 'Plates gathering cycle duration')
+PLATES_LAG_DAYS = REGISTRY.gauge('reports_plates_lag_days', 'Days between the last stored plates report and today')
 
 
 class PlatesReportProducer:
-    def __init__(self):
-        self.__logger: object = None
-        self.__dbconnector_ws: object = None
-        self.__dbconnector_is: object = None
+    # pools and logger are shared when hosted by single process Application
+    def __init__(self, dbconnector_ws=None, dbconnector_is=None, logger=None, exporter=None):
+        self.__logger: object = logger
+        self.__exporter: object = exporter
+        self.__dbconnector_ws: object = dbconnector_ws
+        self.__dbconnector_is: object = dbconnector_is
         self.__eventsignal = False
         self.__eventloop = None
         self.name = 'PlateDataMiner'
         self.type = 'gather'
         self.alias = 'plates'
         self.__schedule = None
+        self.__batch = True
+        self.__scheduler = None
+        self.__supervisor = None
+        self.__incremental = True
+        # terId -> today's running counters and last processed transit id
+        self.__counters = {}
 
     @property
     def eventloop(self):
@@ -52,26 +67,127 @@ class PlatesReportProducer:
     def eventsignal(self):
         return self.__eventsignal
 
+    # completes raw rep_grz counters with derived values
+    @staticmethod
+    def _convert(data_out, date):
+        if data_out is None:
+            return {'date': date, 'totalTransits': 0, 'more6symbols': 0, 'less6symbols': 0, 'noSymbols': 0, 'accuracy': 0}
+        data_out['noSymbols'] = data_out['totalTransits'] - data_out['more6symbols'] - data_out['less6symbols']
+        data_out['accuracy'] = 0
+        if data_out['totalTransits'] > 0:
+            data_out['accuracy'] = int(round(data_out['more6symbols']/data_out['totalTransits']*100, 2))
+        return data_out
+
+    @staticmethod
+    def _record(device: dict, data_out: dict):
+        return [device['terAddress'], device['terType'], device['terDescription'], data_out['totalTransits'], data_out['more6symbols'], data_out['less6symbols'],
+                data_out['noSymbols'], data_out['accuracy'], device['camPlateMode'], data_out['date']]
+
     # subprocessing coroutine for fetching and storing data
     # processes 1 device object and one date
     async def _fetch(self, device: dict, date: datetime):
-        data_out = await self.__dbconnector_ws.callproc('rep_grz', rows=1, values=[device['terId'], date])
-        if data_out is None:
-            data_out = {'date': date, 'totalTransits': 0, 'more6symbols': 0, 'less6symbols': 0, 'less6symbols': 0, 'noSymbols': 0, 'accuracy': 0}
-        else:
-            data_out['noSymbols'] = data_out['totalTransits'] - data_out['more6symbols'] - data_out['less6symbols']
-            if data_out['totalTransits'] > 0:
-                data_out['accuracy'] = int(round(data_out['more6symbols']/data_out['totalTransits']*100, 2))
-        await self.__dbconnector_is.callproc('rep_plates_ins', rows=0,
-                                             values=[device['terAddress'], device['terType'], device['terDescription'], data_out['totalTransits'], data_out['more6symbols'], data_out['less6symbols'],
-                                                     data_out['noSymbols'], data_out['accuracy'], device['camPlateMode'], data_out['date']])
-
-    # coroutine for iteration over dates
-    async def _process(self, device: dict, dates: list):
-        tasks = []
-        for d in dates:
-            tasks.append(self._fetch(device, d))
-        await asyncio.gather(*tasks)
+        async with self.__scheduler.quota('wisepark'):
+            data_out = await self.__dbconnector_ws.callproc('rep_grz', rows=1, values=[device['terId'], date])
+        data_out = self._convert(data_out, date)
+        async with self.__scheduler.quota('integration'):
+            await self.__dbconnector_is.callproc('rep_plates_ins', rows=0, values=self._record(device, data_out))
+
+    # per device and date units, bounded in flight, retried and journaled
+    async def _process(self, devices: list, dates: list, run_id=None):
+        units = [(f"{c['terId']}:{d}", (c, d)) for c in devices for d in dates]
+        params = {'devices': [c['terId'] for c in devices], 'dates': [str(d) for d in dates]}
+        failed = await self.__scheduler.run(run_id or f'{dates[0]}:{dates[-1]}', units, self._fetch, params)
+        for unit, error in failed.items():
+            await self.__logger.error({'module': self.name, 'unit': unit, 'error': repr(error)})
+        return failed
+
+    # finishes the journaled run left by a crash or failed units first,
+    # its range is no longer derivable from the stored reports
+    # returns False while the run is kept for another resume
+    async def _resume(self, devices: list):
+        pending = self.__scheduler.pending()
+        if pending is None:
+            return True
+        run_id, params = pending
+        await self.__logger.info({'module': self.name, 'msg': 'Resuming run', 'run': run_id})
+        terids = set(params['devices'])
+        devices = [c for c in devices if c['terId'] in terids]
+        dates = [date.fromisoformat(d) for d in params['dates']]
+        failed = await self._process(devices, dates, run_id)
+        if self.__scheduler.pending() is not None:
+            return False
+        if failed:
+            await self.__logger.warning({'module': self.name, 'msg': 'Run dropped after resumes, failed units are not retried',
+                                         'run': run_id, 'units': sorted(failed)})
+        return True
+
+    # set-based path: one grouped query for all devices and dates
+    # and one bulk insert of all records
+    async def _process_batch(self, devices: list, dates: list):
+        stats = await self.__dbconnector_ws.callproc('rep_grz_range', rows=-1, values=[dates[0], dates[-1]])
+        grouped = {}
+        for s in stats:
+            rep_date = s['date'].date() if isinstance(s['date'], datetime) else s['date']
+            grouped[(s['terId'], rep_date)] = s
+        records = []
+        for device in devices:
+            for d in dates:
+                records.append(self._record(device, self._convert(grouped.get((device['terId'], d)), d)))
+        await self.__dbconnector_is.callproc('rep_plates_bulk_ins', rows=0, values=[json.dumps(records, default=str)])
+
+    # tries set-based path, falls back to per device and date queries
+    # on DB schemas without rep_grz_range/rep_plates_bulk_ins
+    async def _gather(self, devices: list, dates: list):
+        if self.__batch:
+            try:
+                await self._process_batch(devices, dates)
+                PLATES_UNITS.inc(len(devices) * len(dates), path='batch')
+                return
+            except Exception as e:
+                if procedure_missing(e):
+                    self.__batch = False
+                await self.__logger.warning({'module': self.name, 'msg': f'Batch query failed, using per device queries: {e!r}'})
+        await self._process(devices, dates)
+        PLATES_UNITS.inc(len(devices) * len(dates), path='units')
+
+    # folds transits newer than the device watermark into today's counters
+    async def _fold(self, device: dict):
+        today = date.today()
+        state = self.__counters.get(device['terId'])
+        if state is None or state['date'] != today:
+            state = {'date': today, 'totalTransits': 0, 'more6symbols': 0, 'less6symbols': 0, 'watermark': 0, 'stored': False}
+            self.__counters[device['terId']] = state
+        async with self.__scheduler.quota('wisepark'):
+            delta = await self.__dbconnector_ws.callproc('rep_grz_delta', rows=1, values=[device['terId'], today, state['watermark']])
+        if delta is not None and delta['lastTransitId'] is not None:
+            state['totalTransits'] += delta['totalTransits']
+            state['more6symbols'] += delta['more6symbols']
+            state['less6symbols'] += delta['less6symbols']
+            state['watermark'] = delta['lastTransitId']
+        elif state['stored']:
+            return
+        data_out = self._convert({'date': today,
+                                  'totalTransits': state['totalTransits'],
+                                  'more6symbols': state['more6symbols'],
+                                  'less6symbols': state['less6symbols']}, today)
+        async with self.__scheduler.quota('integration'):
+            await self.__dbconnector_is.callproc('rep_plates_ins', rows=0, values=self._record(device, data_out))
+        state['stored'] = True
+
+    # keeps today's rows current, falls back to full recompute
+    # on DB schemas without rep_grz_delta
+    async def _update_today(self, devices: list):
+        if self.__incremental:
+            try:
+                await asyncio.gather(*[self._fold(c) for c in devices])
+                PLATES_UNITS.inc(len(devices), path='incremental')
+                return
+            except Exception as e:
+                if procedure_missing(e):
+                    self.__incremental = False
+                    self.__counters = {}
+                await self.__logger.warning({'module': self.name, 'msg': f'Incremental query failed, recomputing today: {e!r}'})
+        await self._gather(devices, [date.today()])
 
     # initialization
     # replaces results
@@ -80,22 +196,26 @@ class PlatesReportProducer:
             configuration = toml.load(cs.CONFIG_FILE)
             reports_settings = toml.load(cs.REPORTS_FILE)
             self.__schedule = reports_settings['gather'][self.alias]['schedule']
-            setproctitle('rep-plates')
-            self.__logger = await AsyncLogger('reports').getlogger()
+            self.__batch = reports_settings['gather'][self.alias].get('batch', True)
+            self.__incremental = reports_settings['gather'][self.alias].get('incremental', True)
+            scheduling = reports_settings['gather'][self.alias].get('scheduling', {})
+            self.__scheduler = UnitScheduler(limit=scheduling.get('limit', 10),
+                                             retries=scheduling.get('retries', 3),
+                                             backoff=scheduling.get('backoff', 1.0),
+                                             journal=f'{cs.TEMPORARY_DIR}/{self.alias}_units.journal',
+                                             resumes=scheduling.get('resumes', 3))
+            self.__scheduler.add_quota('wisepark', scheduling.get('wisepark', 5))
+            self.__scheduler.add_quota('integration', scheduling.get('integration', 5))
+            if self.__logger is None:
+                self.__logger = await shared_logger().getlogger()
             await self.__logger.info({'module': self.name, 'msg': 'Starting...'})
-            self.__dbconnector_is = AsyncDBPool(host=configuration['integration']['rdbs']['host'],
-                                                port=configuration['integration']['rdbs']['port'],
-                                                login=configuration['integration']['rdbs']['login'],
-                                                password=configuration['integration']['rdbs']['password'],
-                                                database=configuration['integration']['rdbs']['database'])
-            self.__dbconnector_ws = AsyncDBPool(host=configuration['wisepark']['rdbs']['host'],
-                                                port=configuration['wisepark']['rdbs']['port'],
-                                                login=configuration['wisepark']['rdbs']['login'],
-                                                password=configuration['wisepark']['rdbs']['password'],
-                                                database=configuration['wisepark']['rdbs']['database'])
             connection_tasks = []
-            connection_tasks.append(self.__dbconnector_is.connect())
-            connection_tasks.append(self.__dbconnector_ws.connect())
+            if self.__dbconnector_is is None:
+                self.__dbconnector_is = InstrumentedDBPool.from_configuration(configuration, 'integration')
+                connection_tasks.append(self.__dbconnector_is.connect())
+            if self.__dbconnector_ws is None:
+                self.__dbconnector_ws = InstrumentedDBPool.from_configuration(configuration, 'wisepark')
+                connection_tasks.append(self.__dbconnector_ws.connect())
             await self.__logger.info({'module': self.name, 'msg': 'Polling...'})
             await asyncio.gather(*connection_tasks)
             report_from_dt = datetime.now()
@@ -104,45 +224,60 @@ class PlatesReportProducer:
             preparation_tasks.append(self.__dbconnector_is.callproc('is_column_get', rows=-1, values=[None]))
             preparation_tasks.append(self.__dbconnector_is.callproc('rep_plates_last_get', rows=1, values=[]))
             columns, last_report = await asyncio.gather(*preparation_tasks)
-            dates = []
-            if last_report is None or last_report['repDate'] is None:
-                report_to_dt = date.today() - timedelta(days=1)
-                report_from_dt = report_to_dt - timedelta(days=30)
-                days_interval = report_to_dt-report_from_dt
-                dates = [report_from_dt + timedelta(days=x) for x in range(0, days_interval.days+1)]
-            else:
-                date_today = date.today()
-                days_interval = date_today-last_report['repDate']
-                dates = [last_report['repDate'] + timedelta(days=x) for x in range(0, days_interval.days+1)]
-            tasks = []
-            for c in columns:
-                tasks.append(self._process(c, dates))
-            await asyncio.gather(*tasks)
+            if await self._resume(columns):
+                dates = []
+                if last_report is None or last_report['repDate'] is None:
+                    report_to_dt = date.today() - timedelta(days=1)
+                    report_from_dt = report_to_dt - timedelta(days=30)
+                    days_interval = report_to_dt-report_from_dt
+                    dates = [report_from_dt + timedelta(days=x) for x in range(0, days_interval.days+1)]
+                else:
+                    date_today = date.today()
+                    days_interval = date_today-last_report['repDate']
+                    dates = [last_report['repDate'] + timedelta(days=x) for x in range(0, days_interval.days+1)]
+                await self._gather(columns, dates)
             await self.__dbconnector_is.callproc('is_processes_ins', rows=0, values=[self.name, 1, os.getpid(), datetime.now()])
             await self.__logger.info({'module': self.name, 'msg': 'Started'})
             return self
         except:
+            if self.__logger is not None:
+                await self.__logger.exception({'module': self.name, 'msg': 'Initialization failed'})
             sys.exit(1)
 
+    async def _heartbeat(self):
+        await self.__dbconnector_is.callproc('is_processes_upd', rows=0, values=[self.name, 1, 0, datetime.now()])
+
+    async def _tick(self):
+        try:
+            with PLATES_CYCLE_SECONDS.time():
+                columns = await self.__dbconnector_is.callproc('is_column_get', rows=-1, values=[None])
+                # retried on the next tick, a new run would replace its journal
+                if not await self._resume(columns):
+                    return
+                last_rep = await self.__dbconnector_is.callproc('rep_plates_last_get', rows=1, values=[])
+                date_today = date.today()
+                PLATES_LAG_DAYS.set((date_today - last_rep['repDate']).days)
+                # closed days are recomputed once in full
+                if last_rep['repDate'] < date_today:
+                    days_interval = date_today-last_rep['repDate']
+                    dates = [last_rep['repDate'] + timedelta(days=x) for x in range(0, days_interval.days)]
+                    await self._gather(columns, dates)
+                await self._update_today(columns)
+                PLATES_LAG_DAYS.set(0)
+        except:
+            await self.__logger.exception({'module': self.name})
+
+    def register(self, supervisor):
+        supervisor.add_job(f'{self.alias}_heartbeat', '* * * * *', self._heartbeat)
+        supervisor.add_job(self.alias, self.__schedule, self._tick)
+
     async def _dispatch(self):
-        while not self.eventsignal:
-            await self.__dbconnector_is.callproc('is_processes_upd', rows=0, values=[self.name, 1, 0, datetime.now()])
-            if pycron.is_now(self.__schedule):
-                try:
-                    last_rep = await self.__dbconnector_is.callproc('rep_plates_last_get', rows=1, values=[])
-                    if last_rep['repDate'] < date.today():
-                        columns = await self.__dbconnector_is.callproc('is_column_get', rows=-1, values=[None])
-                        date_today = date.today()
-                        days_interval = date_today-last_rep['repDate']
-                        dates = [last_rep['repDate'] + timedelta(days=x) for x in range(0, days_interval.days)]
-                        dates.append(date_today)
-                        tasks = []
-                        for c in columns:
-                            tasks.append(self._process(c, dates))
-                        await asyncio.gather(*tasks)
-                except:
-                    await self.__logger.exception({'module': self.name})
-            await asyncio.sleep(60)
+        # metrics of this worker process, see Application
+        if self.__exporter is not None:
+            await self.__exporter.start()
+        self.__supervisor = CronSupervisor(self.__logger)
+        self.register(self.__supervisor)
+        await self.__supervisor.run()
 
     async def _signal_cleanup(self):
         await self.__logger.warning({'module': self.name, 'msg': 'Shutting down'})
@@ -155,6 +290,8 @@ class PlatesReportProducer:
     async def _signal_handler(self, signal):
         # stop while loop coroutine
         self.eventsignal = True
+        if self.__supervisor is not None:
+            self.__supervisor.stop()
         tasks = [task for task in asyncio.all_tasks(self.eventloop) if task is not
                  asyncio.tasks.current_task()]
         for t in tasks:
@@ -170,6 +307,7 @@ class PlatesReportProducer:
         sys.exit(0)
 
     def run(self):
+        setproctitle('rep-plates')
         # use own loop
         uvloop.install()
         self.eventloop = asyncio.new_event_loop()
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+
+
+class UnitScheduler:
+    """
+    Runs independent units of work with a bounded number in flight.
+
+    Every unit is retried with exponential backoff on its own, completed
+    units are appended to a journal so a restarted run with the same id
+    skips them. The journal starts with the run id and params, pending()
+    returns them until the run completes, so a caller resumes the run
+    before starting another one. A run still failing after resumes resumes
+    is dropped, its failed units are returned and not journaled anymore.
+    Named quotas limit concurrent calls per DB.
+    """
+
+    def __init__(self, limit=10, retries=3, backoff=1.0, journal=None, resumes=3):
+        self.__limit = limit
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__journal = journal
+        self.__resumes = resumes
+        self.__quotas = {}
+
+    def add_quota(self, name, size):
+        self.__quotas[name] = asyncio.Semaphore(size)
+        return self
+
+    def quota(self, name):
+        return self.__quotas[name]
+
+    def _load_journal(self):
+        header = None
+        completed = set()
+        resumes = 0
+        if self.__journal is None or not os.path.exists(self.__journal):
+            return header, completed, resumes
+        with open(self.__journal, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'params' in record:
+                    header = record
+                    completed = set()
+                    resumes = 0
+                elif header is None or record['run'] != header['run']:
+                    continue
+                elif 'resume' in record:
+                    resumes += 1
+                else:
+                    completed.add(record['unit'])
+        return header, completed, resumes
+
+    def pending(self):
+        """
+        Returns (run_id, params) of the journaled run that did not complete, or None.
+        """
+        header, _, _ = self._load_journal()
+        if header is None:
+            return None
+        return header['run'], header['params']
+
+    async def _attempt(self, worker, args):
+        for attempt in range(self.__retries + 1):
+            try:
+                await worker(*args)
+                return None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == self.__retries:
+                    return e
+                await asyncio.sleep(self.__backoff * 2 ** attempt)
+
+    async def run(self, run_id, units, worker, params=None):
+        """
+        units: list of (key, args), worker(*args) is awaited per unit.
+        params: JSON serializable definition of the run, see pending().
+        Returns {key: exception} of units failed after all retries.
+        """
+        header, completed, resumes = self._load_journal()
+        resumed = header is not None and header['run'] == run_id
+        if not resumed:
+            completed = set()
+            resumes = 0
+        journal = None
+        if self.__journal is not None:
+            # a run of another id replaces the journal
+            journal = open(self.__journal, 'a' if resumed else 'w')
+            if resumed:
+                resumes += 1
+                journal.write(json.dumps({'run': run_id, 'resume': resumes}) + '\n')
+            else:
+                journal.write(json.dumps({'run': run_id, 'params': params}) + '\n')
+            journal.flush()
+        queue = asyncio.Queue()
+        for key, args in units:
+            if key not in completed:
+                queue.put_nowait((key, args))
+        failed = {}
+
+        async def consume():
+            while not queue.empty():
+                key, args = queue.get_nowait()
+                error = await self._attempt(worker, args)
+                if error is not None:
+                    failed[key] = error
+                elif journal is not None:
+                    journal.write(json.dumps({'run': run_id, 'unit': key}) + '\n')
+                    journal.flush()
+
+        try:
+            await asyncio.gather(*[consume() for _ in range(min(self.__limit, queue.qsize()))])
+        finally:
+            if journal is not None:
+                journal.close()
+        # a unit failing on every resume must not hold back later runs
+        done = not failed or resumes >= self.__resumes
+        if done and self.__journal is not None and os.path.exists(self.__journal):
+            os.remove(self.__journal)
+        return failed
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+
+class ReportCache:
+    """
+    LRU cache of rendered reports and raw query results on disk.
+
+    Entries for periods closed before today never expire, entries for
+    periods including today live ttl seconds (ttl=0 disables them).
+    The least recently used entries are evicted above size bytes.
+    Hits and misses are counted per kind, the first part of the key.
+    Entries keep a meta dict (e.g. row counts) given when they are stored.
+    """
+
+    def __init__(self, directory, size=512 * 1024 * 1024, ttl=300):
+        self._sweep(directory)
+        self.__directory = f"{directory}/{os.getpid()}"
+        self.__size = size
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.__used = 0
+        self.hits = 0
+        self.misses = 0
+        # kind -> [hits, misses]
+        self.__kinds = {}
+        shutil.rmtree(self.__directory, ignore_errors=True)
+        os.makedirs(self.__directory, exist_ok=True)
+
+    # directories of previous processes, cache files are per process
+    @staticmethod
+    def _sweep(directory):
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if not name.isdigit():
+                continue
+            try:
+                os.kill(int(name), 0)
+                alive = int(name) != os.getpid()
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+            if not alive:
+                shutil.rmtree(f"{directory}/{name}", ignore_errors=True)
+
+    @staticmethod
+    def key(kind, *parts):
+        digest = hashlib.sha1("|".join(str(p) for p in (kind,) + parts).encode()).hexdigest()
+        return f"{kind}-{digest}"
+
+    def ttl_for(self, report_stop_date):
+        # the stop day is included in the report
+        stop = datetime.strptime(report_stop_date, "%Y-%m-%d %H:%M:%S")
+        if stop.date() < date.today():
+            return None
+        return self.__ttl
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.__entries),
+            "bytes": self.__used,
+            "capacity": self.__size,
+            "kinds": {kind: {"hits": hits, "misses": misses} for kind, (hits, misses) in self.__kinds.items()},
+        }
+
+    def get(self, key, meta=None):
+        """
+        Path of the entry or None, meta is updated with the entry meta.
+        """
+        counters = self.__kinds.setdefault(key.split("-", 1)[0], [0, 0])
+        entry = self.__entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] < time.time():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            counters[1] += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        counters[0] += 1
+        if meta is not None:
+            meta.update(entry[3])
+        return entry[0]
+
+    def load(self, key, meta=None):
+        path = self.get(key, meta)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, key, content, ttl, meta=None):
+        if ttl == 0 or len(content) > self.__size:
+            return
+        path = f"{self.__directory}/{key}"
+        with open(path, "wb") as f:
+            f.write(content)
+        self._register(key, path, ttl, meta)
+
+    # passes the source chunks through and keeps a copy when it completes,
+    # meta is stored as filled by then, a hit updates it from the entry
+    async def stream(self, key, source, ttl, meta=None):
+        path = self.get(key, meta)
+        if path is not None:
+            with open(path, "rb") as f:
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data:
+                        break
+                    yield data
+            return
+        if ttl == 0:
+            async for data in source:
+                yield data
+            return
+        path = f"{self.__directory}/{key}"
+        # own file per writer, concurrent misses of a key do not share it
+        fd, part = tempfile.mkstemp(dir=self.__directory, suffix=".part")
+        completed = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for data in source:
+                    f.write(data)
+                    yield data
+            completed = True
+        finally:
+            # caching is best effort, errors never reach the consumer
+            try:
+                if completed:
+                    os.replace(part, path)
+                    self._register(key, path, ttl, meta)
+                elif os.path.exists(part):
+                    os.remove(part)
+            except OSError:
+                pass
+
+    def _register(self, key, path, ttl, meta=None):
+        if key in self.__entries:
+            self.__used -= self.__entries[key][1]
+        size = os.path.getsize(path)
+        if size > self.__size:
+            self.__entries.pop(key, None)
+            os.remove(path)
+            return
+        expires = None if ttl is None else time.time() + ttl
+        self.__entries[key] = (path, size, expires, dict(meta or {}))
+        self.__entries.move_to_end(key)
+        self.__used += size
+        while self.__used > self.__size:
+            self._remove(next(iter(self.__entries)))
+
+    def _remove(self, key):
+        path, size, _, _ = self.__entries.pop(key)
+        self.__used -= size
+        if os.path.exists(path):
+            os.remove(path)
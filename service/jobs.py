@@ -0,0 +1,146 @@
+import asyncio
+import os
+import time
+import uuid
+from decimal import Decimal
+
+from modules.reports.common.profiling import profile
+
+
+class ReportJob:
+    def __init__(self, option, report_start_date, report_stop_date, directory, format="xlsx", profile=False,
+                 sites=None, layout="sheets"):
+        self.id = uuid.uuid4().hex
+        self.option = option
+        self.format = format
+        # Site objects, None for the primary parking
+        self.sites = sites
+        self.layout = layout
+        self.report_start_date = report_start_date
+        self.report_stop_date = report_stop_date
+        self.filename = f"{directory}/{self.id}.{format}"
+        self.profile = profile
+        self.profile_filename = f"{directory}/{self.id}.folded"
+        self.profile_summary = None
+        self.status = "queued"
+        self.fetched = 0
+        self.written = 0
+        self.totals = {}
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.status in ("finished", "failed")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "option": self.option,
+            "format": self.format,
+            "sites": [site.id for site in self.sites] if self.sites else None,
+            "layout": self.layout,
+            "status": self.status,
+            "fetched": self.fetched,
+            "written": self.written,
+            "totals": {name: str(value) if isinstance(value, Decimal) else value
+                       for name, value in self.totals.items()},
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+            "profile": self.profile_summary,
+        }
+
+
+class ReportJobQueue:
+    """
+    Bounded pool of workers rendering reports in background.
+
+    Renderers are report generators called with the job period, they write
+    job.filename and update job.fetched/job.written counters through the
+    progress argument. Finished files are removed after ttl seconds.
+    Jobs submitted with profile=True also write a folded stacks profile.
+    """
+
+    def __init__(self, directory, workers=2, size=32, ttl=3600, profile_interval=0.005, logger=None):
+        self.__directory = directory
+        self.__logger = logger
+        self.__profile_interval = profile_interval
+        self.__workers = workers
+        self.__size = size
+        self.__ttl = ttl
+        self.__queue = None
+        self.__jobs = {}
+        self.__renderers = {}
+        self.__tasks = []
+
+    async def start(self, renderers):
+        self.__renderers = renderers
+        self.__queue = asyncio.Queue(maxsize=self.__size)
+        for _ in range(self.__workers):
+            self.__tasks.append(asyncio.ensure_future(self._worker()))
+        self.__tasks.append(asyncio.ensure_future(self._cleanup()))
+        return self
+
+    async def stop(self):
+        for t in self.__tasks:
+            t.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks = []
+
+    def submit(self, option, report_start_date, report_stop_date, format="xlsx", profile=False, sites=None,
+               layout="sheets"):
+        if option not in self.__renderers:
+            raise KeyError(option)
+        job = ReportJob(option, report_start_date, report_stop_date, self.__directory, format, profile, sites, layout)
+        # raises asyncio.QueueFull when all slots are taken
+        self.__queue.put_nowait(job)
+        self.__jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        return self.__jobs.get(job_id)
+
+    async def _worker(self):
+        while True:
+            job = await self.__queue.get()
+            job.status = "running"
+            try:
+                coroutine = self.__renderers[job.option](
+                    job.report_start_date,
+                    job.report_stop_date,
+                    filename=job.filename,
+                    progress=job,
+                    format=job.format,
+                    sites=job.sites,
+                    layout=job.layout,
+                )
+                if job.profile:
+                    request_profile = await profile(coroutine, self.__profile_interval)
+                    with open(job.profile_filename, "w") as f:
+                        f.write(request_profile.folded())
+                    job.profile_summary = request_profile.summary()
+                else:
+                    await coroutine
+                job.status = "finished"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = repr(e)
+                if self.__logger is not None:
+                    await self.__logger.exception({"module": "ReportJobQueue", "job": job.id, "option": job.option})
+            finally:
+                job.finished = time.time()
+                self.__queue.task_done()
+
+    async def _cleanup(self):
+        while True:
+            await asyncio.sleep(min(self.__ttl, 60))
+            expired = [j for j in self.__jobs.values() if j.done and time.time() - j.finished > self.__ttl]
+            for job in expired:
+                del self.__jobs[job.id]
+                for filename in (job.filename, job.profile_filename):
+                    if os.path.exists(filename):
+                        os.remove(filename)
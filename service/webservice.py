@@ -1,15 +1,17 @@
+import asyncio
 import codecs
-import os
+import pickle
 import re
 import tempfile
-from datetime import datetime
+import time
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from types import SimpleNamespace
+from typing import List
 
-import openpyxl
 import toml
 import uvicorn
 from fastapi import FastAPI, Form
-from starlette.background import BackgroundTasks
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
 from starlette.responses import (
@@ -22,8 +24,28 @@ from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 
 import configuration.settings as cs
-from utils.asynclog import AsyncLogger
-from utils.asyncsql import AsyncDBPool
+from modules.reports.common.columnar import accumulate
+from modules.reports.common.dbpool import InstrumentedDBPool, StreamingDBPool, procedure_missing
+from modules.reports.common.exports import (
+    CsvStreamWriter,
+    ParquetStreamWriter,
+    available_formats,
+)
+from modules.reports.common.metrics import CONTENT_TYPE, REGISTRY
+from modules.reports.common import profiling
+from modules.reports.common.sites import SiteRegistry, sum_records
+from modules.reports.common.render import (
+    RENDER_BYTES,
+    RENDER_ROWS,
+    RENDER_SECONDS,
+    RenderExecutor,
+)
+from modules.reports.common.templates import TemplateCache
+from modules.reports.common.xlsxstream import ChunkSink, XlsxStreamWriter
+from modules.reports.common.logger import shared_logger
+from modules.reports.producer.consolidated import CONSOLIDATED_METRICS
+from modules.reports.service.cache import ReportCache
+from modules.reports.service.jobs import ReportJobQueue
 
 app = FastAPI()
 
@@ -33,15 +55,51 @@ name = "reports"
 CONFIGURATION = toml.load(cs.CONFIG_FILE)
 TEMPLATES = Jinja2Templates(directory=f"{Path(Path(__file__).parents[0])}/templates")
 RESOURCES_DIR = f"{Path(cs.RESOURCES_DIR)}/ampp/"
-DBCONNECTOR_WS = AsyncDBPool(
-    hots=CONFIGURATION["wisepark"]["rdbs"]["host"],
-    port=CONFIGURATION["wisepark"]["rdbs"]["port"],
-    login=CONFIGURATION["wisepark"]["rdbs"]["login"],
-    password=CONFIGURATION["wisepark"]["rdbs"]["password"],
-    database=CONFIGURATION["wisepark"]["rdbs"]["databse"],
+# WisePark pool per parking, the primary one is this deployment's parking
+SITES = SiteRegistry.from_configuration(CONFIGURATION, StreamingDBPool)
+DBCONNECTOR_WS = SITES.primary.dbconnector
+
+# daily rollup of the consolidated report, see ConsolidatedRollupProducer
+DBCONNECTOR_IS = InstrumentedDBPool.from_configuration(CONFIGURATION, "integration")
+ROLLUP = {"enabled": CONFIGURATION["reports"].get("rollup", True)}
+
+
+TEMPLATE_CACHE = TemplateCache()
+RENDER_EXECUTOR = RenderExecutor(
+    CONFIGURATION["reports"].get("render", {}).get("workers")
+)
+CACHE_SETTINGS = CONFIGURATION["reports"].get("cache", {})
+REPORT_CACHE = ReportCache(
+    CACHE_SETTINGS.get("directory", f"{cs.TEMPORARY_DIR}/cache"),
+    size=CACHE_SETTINGS.get("size", 512 * 1024 * 1024),
+    ttl=CACHE_SETTINGS.get("ttl", 300),
+)
+LOGGER = shared_logger()
+JOBS_SETTINGS = CONFIGURATION["reports"].get("jobs", {})
+# profile every job when enabled, otherwise only jobs requested with ?profile=1
+PROFILE_SETTINGS = CONFIGURATION["reports"].get("profile", {})
+JOBS = ReportJobQueue(
+    cs.TEMPORARY_DIR,
+    workers=JOBS_SETTINGS.get("workers", 2),
+    size=JOBS_SETTINGS.get("size", 32),
+    ttl=JOBS_SETTINGS.get("ttl", 3600),
+    profile_interval=PROFILE_SETTINGS.get("interval", 0.005),
+    logger=LOGGER,
 )
 
 
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+MEDIA_TYPES = {
+    "xlsx": XLSX_MEDIA_TYPE,
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+# csv/parquet skip styling, only the detailed report has rows to export
+FORMATS = {"detailed": available_formats(), "consolidated": ["xlsx"]}
+# several parkings: a sheet per parking or one combined sheet,
+# csv/parquet are always combined, rows carry parkingId
+LAYOUTS = ("sheets", "summary")
+
 enabled = False
 report = ""
 
@@ -49,130 +107,476 @@ TEMPLATES.env.filters["enabled"] = enabled
 TEMPLATES.env.filters["option"] = report
 
 
+DETAILED_COLUMNS = (
+    ("A", "idx"),
+    ("B", "parkingId"),
+    ("C", "ticketNumber"),
+    ("D", "sessionNumber"),
+    ("E", "traEntryTS"),
+    ("F", "traPayTS"),
+    ("G", "traExitTS"),
+    ("H", "sessionDuration"),
+    ("I", "traPlate"),
+    ("J", "traPaySum"),
+    ("K", "traPayPaid"),
+    ("L", "traPayType"),
+    ("M", "traPayChange"),
+    ("N", "ticketWithoutChange"),
+    ("O", "payRRN"),
+    ("P", "sessionStatus"),
+)
+
+
 def convert_keys(d):
-    dict_converted = {}
-    dict_converted["A"] = d["idx"]
-    dict_converted["B"] = d["parkingId"]
-    dict_converted["C"] = d["ticketNumber"]
-    dict_converted["D"] = d["sessionNumber"]
-    dict_converted["E"] = d["traEntryTS"]
-    dict_converted["F"] = d["traPayTS"]
-    dict_converted["G"] = d["traExitTS"]
-    dict_converted["H"] = d["sessionDuration"]
-    dict_converted["I"] = d["traPlate"]
-    dict_converted["J"] = d["traPaySum"]
-    dict_converted["K"] = d["traPayPaid"]
-    dict_converted["L"] = d["traPayType"]
-    dict_converted["M"] = d["traPayChange"]
-    dict_converted["N"] = d["ticketWithoutChange"]
-    dict_converted["O"] = d["payRRN"]
-    dict_converted["P"] = d["sessionStatus"]
-    return dict_converted
-
-
-async def detailed_report_generator(report_start_date, report_stop_date):
-    data = await DBCONNECTOR_WS.callproc(
+    return {column: d[key] for column, key in DETAILED_COLUMNS}
+
+
+CONSOLIDATED_CELLS = (
+    ("D9", "entries"),
+    ("D10", "payments"),
+    ("D11", "exits"),
+    ("D12", "unpaidExits"),
+    ("D14", "lostTickets"),
+    ("D15", "lostTicketSum"),
+    ("D17", "totalPayments"),
+    ("D18", "cashPayments"),
+    ("D19", "cardPayments"),
+    ("D20", "troikaPayments"),
+    ("D21", "otherPayments"),
+)
+
+
+# A-P ordered keys for write-only sheet
+DETAILED_KEYS = tuple(key for _, key in DETAILED_COLUMNS)
+DETAILED_TOTALS = ("traPaySum", "traPayPaid", "traPayChange")
+# parquet column types, a first batch of NULLs must not decide them
+DETAILED_TYPES = {
+    "idx": "int",
+    "parkingId": "int",
+    "ticketNumber": "string",
+    "sessionNumber": "string",
+    "traEntryTS": "timestamp",
+    "traPayTS": "timestamp",
+    "traExitTS": "timestamp",
+    "sessionDuration": "string",
+    "traPlate": "string",
+    "traPaySum": "decimal",
+    "traPayPaid": "decimal",
+    "traPayType": "string",
+    "traPayChange": "decimal",
+    "ticketWithoutChange": "decimal",
+    "payRRN": "string",
+    "sessionStatus": "string",
+}
+
+
+def session_duration(entry, exit):
+    if entry is None or exit is None:
+        return None
+    return str(exit - entry)
+
+
+# derived columns are computed per batch column, not per row;
+# ampp_detailedrep_get returns sessionDuration, it is only derived
+# for procedure versions without that column
+def prepare_batch(batch):
+    if "sessionDuration" not in batch:
+        batch.derive("sessionDuration", session_duration, "traEntryTS", "traExitTS")
+    return batch
+
+
+def sites_label(sites):
+    return str(sites[0].id) if len(sites) == 1 else "sites"
+
+
+def detailed_report_header(report_start_date, report_stop_date, sites):
+    return {
+        "A3": ", ".join(str(site.id) for site in sites),
+        "A4": ", ".join(f"{site.name}" for site in sites),
+        "A5": f" {report_start_date} - {report_stop_date}",
+        "A7": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def detailed_report_writer(
+    sink, report_start_date, report_stop_date, format="xlsx", sites=None, title=None
+):
+    if format == "csv":
+        return CsvStreamWriter(sink, DETAILED_KEYS)
+    if format == "parquet":
+        return ParquetStreamWriter(sink, DETAILED_KEYS, DETAILED_TYPES)
+    return XlsxStreamWriter(
+        TEMPLATE_CACHE.get(f"{RESOURCES_DIR}/detailed_report.xlsx"),
+        sink,
+        appends=detailed_report_header(report_start_date, report_stop_date, sites),
+        title=title,
+    )
+
+
+def detailed_report_sheet(writer, report_start_date, report_stop_date, site):
+    writer.add_sheet(
+        TEMPLATE_CACHE.get(f"{RESOURCES_DIR}/detailed_report.xlsx"),
+        appends=detailed_report_header(report_start_date, report_stop_date, [site]),
+        title=str(site.id),
+    )
+
+
+def write_batch(writer, batch):
+    if isinstance(writer, XlsxStreamWriter):
+        for row in batch.rows(DETAILED_KEYS):
+            writer.append(row)
+    else:
+        writer.write_batch(batch)
+
+
+async def detailed_site_batches(site, report_start_date, report_stop_date):
+    async for chunk in site.dbconnector.callproc_stream(
         "ampp_detailedrep_get",
-        rows=-1,
-        values=[AMPP_ID, report_start_date, report_stop_date],
-    )
-    rows_data = []
-    for d in data:
-        d_converted = convert_keys(d)
-        rows_data.append(d_converted)
-    wb = openpyxl.load_workbook(f"{RESOURCES_DIR}/detailed_report.xlsx")
-    ws = wb.active
-    ws.unmerge_cells("A3:P3")
-    num = ws["A3"].value
-    ws["A3"] = num + f"{CONFIGURATION['ampp']['id']}"
-    ws.merge_cells("A3:P3")
-    ws.unmerge_cells("A4:P4")
-    addr = ws["A4"].value
-    ws["A4"] = addr + f"{cs.AMPP}"
-    ws.merge_cells("A4:P4")
-    ws.unmerge_cells("A5:P5")
-    period = ws["A5"].value
-    ws["A5"] = f"{period} {report_start_date} - {report_stop_date}"
-    ws.merge_cells("A5:P5")
-    ws.unmerge_cells("A7:P7")
-    date = ws["A7"].value
-    ws["A7"] = f"{date}{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    ws.merge_cells("A7:P7")
-    for rd in rows_data:
-        ws.append(rd)
-    filename = f"{cs.TEMPORARY_DIR}/{CONFIGURATION['ampp']['id']}_detailed.xlsx"
-    wb.save(filename)
+        values=[site.id, report_start_date, report_stop_date],
+        columnar=True,
+    ):
+        yield prepare_batch(chunk)
+
+
+# (sites of the sheet, batches) per sheet of the report
+async def detailed_report_parts(report_start_date, report_stop_date, sites, sheets):
+    def fetch(site):
+        return detailed_site_batches(site, report_start_date, report_stop_date)
+
+    if len(sites) == 1:
+        yield sites, fetch(sites[0])
+    elif sheets:
+        async for site, batches in SITES.ordered(fetch, sites):
+            yield [site], batches
+    else:
+        yield sites, (batch async for _, batch in SITES.merged(fetch, sites))
+
+
+# yields report bytes while rows are still arriving from the DB
+async def detailed_report_render(
+    report_start_date,
+    report_stop_date,
+    progress=None,
+    format="xlsx",
+    sites=None,
+    layout="sheets",
+):
+    sites = sites or [SITES.primary]
+    sheets = format == "xlsx" and layout == "sheets" and len(sites) > 1
+    sink = ChunkSink()
+    writer = None
+    # writer time only, DB time is in reports_db_call_seconds
+    elapsed = 0.0
+    size = 0
+    async for part_sites, batches in detailed_report_parts(
+        report_start_date, report_stop_date, sites, sheets
+    ):
+        if writer is None:
+            writer = detailed_report_writer(
+                sink,
+                report_start_date,
+                report_stop_date,
+                format,
+                part_sites,
+                title=str(part_sites[0].id) if sheets else None,
+            )
+        else:
+            await profiling.to_thread(
+                detailed_report_sheet, writer, report_start_date, report_stop_date, part_sites[0]
+            )
+        data = sink.drain()
+        if data:
+            size += len(data)
+            yield data
+        async for chunk in batches:
+            if progress is not None:
+                progress.fetched += len(chunk)
+                accumulate(progress.totals, chunk, *DETAILED_TOTALS)
+            started = time.perf_counter()
+            # serialization is CPU-bound, keep the event loop free
+            await profiling.to_thread(write_batch, writer, chunk)
+            elapsed += time.perf_counter() - started
+            RENDER_ROWS.inc(len(chunk), report="detailed", format=format)
+            if progress is not None:
+                progress.written += len(chunk)
+            data = sink.drain()
+            if data:
+                size += len(data)
+                yield data
+    started = time.perf_counter()
+    await profiling.to_thread(writer.close)
+    elapsed += time.perf_counter() - started
+    data = sink.drain()
+    RENDER_SECONDS.observe(elapsed, report="detailed", format=format)
+    RENDER_BYTES.inc(size + len(data), report="detailed", format=format)
+    yield data
+
+
+def replay_progress(progress, meta):
+    if progress is None:
+        return
+    progress.fetched += meta.get("fetched", 0)
+    progress.written += meta.get("written", 0)
+    for name, value in meta.get("totals", {}).items():
+        progress.totals[name] = progress.totals.get(name, 0) + value
+
+
+async def detailed_report_stream(
+    report_start_date,
+    report_stop_date,
+    progress=None,
+    format="xlsx",
+    sites=None,
+    layout="sheets",
+):
+    sites = sites or [SITES.primary]
+    key = REPORT_CACHE.key(
+        "detailed",
+        ",".join(str(site.id) for site in sites),
+        report_start_date,
+        report_stop_date,
+        format,
+        layout if len(sites) > 1 else "",
+    )
+    # counters are stored with the cached report and replayed on a hit
+    counted = progress if progress is not None else SimpleNamespace(fetched=0, written=0, totals={})
+    fetched, written = counted.fetched, counted.written
+    meta = {}
+    rendered = False
+
+    async def render():
+        nonlocal rendered
+        rendered = True
+        async for data in detailed_report_render(
+            report_start_date, report_stop_date, counted, format, sites, layout
+        ):
+            yield data
+        meta.update(
+            fetched=counted.fetched - fetched,
+            written=counted.written - written,
+            totals=dict(counted.totals),
+        )
+
+    async for data in REPORT_CACHE.stream(
+        key, render(), REPORT_CACHE.ttl_for(report_stop_date), meta
+    ):
+        yield data
+    if not rendered:
+        replay_progress(progress, meta)
+
+
+async def detailed_report_generator(
+    report_start_date,
+    report_stop_date,
+    filename=None,
+    progress=None,
+    format="xlsx",
+    sites=None,
+    layout="sheets",
+):
+    sites = sites or [SITES.primary]
+    if filename is None:
+        filename = f"{cs.TEMPORARY_DIR}/{sites_label(sites)}_detailed.{format}"
+    with open(filename, "wb") as f:
+        async for data in detailed_report_stream(
+            report_start_date, report_stop_date, progress, format, sites, layout
+        ):
+            f.write(data)
     return filename
 
 
-async def consolidated_report_generator(report_start_date, report_stop_date):
-    data = await DBCONNECTOR.callproc(
-        "ampp_consolidatedrep_get", rows=1, values=[report_start_date, report_stop_date]
-    )
-    wb = openpyxl.load_workbook(f"{RESOURCES_DIR}/consolidated_report.xlsx")
-    ws = wb.active
-    ws.unmerge_cells("A3:E3")
-    num = ws["A3"].value
-    ws["A3"] = num + f"{CONFIGURATION['ampp']['id']}"
-    ws.merge_cells("A3:E3")
-    ws.unmerge_cells("A4:E4")
-    addr = ws["A4"].value
-    ws["A4"] = addr + f"{CONFIGURATION['ampp']['address']}"
-    ws.merge_cells("A4:E4")
-    ws.unmerge_cells("A5:E5")
-    period = ws["A5"].value
-    ws["A5"] = f"{period} {report_start_date} - {report_stop_date}"
-    ws.merge_cells("A5:E5")
-    ws.unmerge_cells("A7:E7")
-    date = ws["A7"].value
-    ws["A7"] = f"{date}{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    ws.merge_cells("A7:E7")
-    ws.unmerge_cells("D9:E9")
-    ws["D9"] = data["entries"]
-    ws.merge_cells("D9:E9")
-    ws.unmerge_cells("D10:E10")
-    ws["D10"] = data["payments"]
-    ws.merge_cells("D10:E10")
-    ws.unmerge_cells("D11:E11")
-    ws["D11"] = data["exits"]
-    ws.merge_cells("D11:E11")
-    ws.unmerge_cells("D12:E12")
-    ws["D12"] = data["unpaidExits"]
-    ws.merge_cells("D12:E12")
-    ws.unmerge_cells("D14:E14")
-    ws["D14"] = data["lostTickets"]
-    ws.merge_cells("D14:E14")
-    ws.unmerge_cells("D15:E15")
-    ws["D15"] = data["lostTicketSum"]
-    ws.merge_cells("D15:E15")
-    ws.unmerge_cells("D17:E17")
-    ws["D17"] = data["totalPayments"]
-    ws.merge_cells("D17:E17")
-    ws.unmerge_cells("D18:E18")
-    ws["D18"] = data["cashPayments"]
-    ws.merge_cells("D18:E18")
-    ws.unmerge_cells("D19:E19")
-    ws["D19"] = data["cardPayments"]
-    ws.merge_cells("D19:E19")
-    ws.unmerge_cells("D20:E20")
-    ws["D20"] = data["troikaPayments"]
-    ws.merge_cells("D20:E20")
-    ws.unmerge_cells("D21:E21")
-    ws["D21"] = data["otherPayments"]
-    ws.merge_cells("D21:E21")
-    filename = f"{TEMPORARY_DIR}/{CONFIGURATION['ampp']['id']}_consolidated.xlsx"
-    wb.save(filename)
+# sums closed days from the rollup table and merges today live,
+# None when the rollup does not cover the closed days yet
+async def consolidated_report_rollup(report_start_date, report_stop_date):
+    start = datetime.strptime(report_start_date, "%Y-%m-%d %H:%M:%S").date()
+    stop = datetime.strptime(report_stop_date, "%Y-%m-%d %H:%M:%S").date()
+    today = date.today()
+    closed_stop = min(stop, today - timedelta(days=1))
+    totals = dict.fromkeys(CONSOLIDATED_METRICS, 0)
+    if start <= closed_stop:
+        rollup = await DBCONNECTOR_IS.callproc(
+            "rep_consolidated_range_get", rows=1, values=[start, closed_stop]
+        )
+        if rollup is None or rollup["days"] < (closed_stop - start).days + 1:
+            return None
+        for key in CONSOLIDATED_METRICS:
+            totals[key] += rollup[key] or 0
+    if start <= today <= stop:
+        period = today.strftime("%Y-%m-%d 00:00:00")
+        live = await SITES.primary.dbconnector.callproc(
+            "ampp_consolidatedrep_get", rows=1, values=[period, period]
+        )
+        for key in CONSOLIDATED_METRICS:
+            totals[key] += (live or {}).get(key) or 0
+    return totals
+
+
+async def consolidated_report_data(report_start_date, report_stop_date, site=None):
+    site = site or SITES.primary
+    key = REPORT_CACHE.key(
+        "consolidated_data",
+        site.id,
+        report_start_date,
+        report_stop_date,
+    )
+    cached = REPORT_CACHE.load(key)
+    if cached is not None:
+        return pickle.loads(cached)
+    data = None
+    # the rollup producer only covers the primary parking
+    if ROLLUP["enabled"] and site is SITES.primary:
+        try:
+            data = await consolidated_report_rollup(report_start_date, report_stop_date)
+        except Exception as e:
+            if procedure_missing(e):
+                ROLLUP["enabled"] = False
+                await LOGGER.warning(
+                    {"module": "webservice", "msg": f"Rollup disabled, using raw transactions: {e!r}"}
+                )
+            else:
+                await LOGGER.exception(
+                    {"module": "webservice", "msg": "Rollup query failed, using raw transactions"}
+                )
+    if data is None:
+        data = await site.dbconnector.callproc(
+            "ampp_consolidatedrep_get",
+            rows=1,
+            values=[report_start_date, report_stop_date],
+        )
+    REPORT_CACHE.put(key, pickle.dumps(data), REPORT_CACHE.ttl_for(report_stop_date))
+    return data
+
+
+def consolidated_report_sheet(report_start_date, report_stop_date, sites, data, title=None):
+    return {
+        "appends": {
+            "A3": ", ".join(str(site.id) for site in sites),
+            "A4": ", ".join(f"{site.address}" for site in sites),
+            "A5": f" {report_start_date} - {report_stop_date}",
+            "A7": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "values": {cell: (data or {}).get(key) for cell, key in CONSOLIDATED_CELLS},
+        "title": title,
+    }
+
+
+async def consolidated_report_render(
+    report_start_date, report_stop_date, progress=None, sites=None, layout="sheets"
+):
+    sites = sites or [SITES.primary]
+    key = REPORT_CACHE.key(
+        "consolidated",
+        ",".join(str(site.id) for site in sites),
+        report_start_date,
+        report_stop_date,
+        layout if len(sites) > 1 else "",
+    )
+    meta = {}
+    content = REPORT_CACHE.load(key, meta)
+    if content is not None:
+        replay_progress(progress, meta)
+        return content
+    data = await SITES.gather(
+        lambda site: consolidated_report_data(report_start_date, report_stop_date, site),
+        sites,
+    )
+    if progress is not None:
+        progress.fetched += len(sites)
+    if len(sites) == 1:
+        sheets = [consolidated_report_sheet(report_start_date, report_stop_date, sites, data[0])]
+    elif layout == "summary":
+        sheets = [
+            consolidated_report_sheet(
+                report_start_date, report_stop_date, sites, sum_records(data, CONSOLIDATED_METRICS)
+            )
+        ]
+    else:
+        sheets = [
+            consolidated_report_sheet(
+                report_start_date, report_stop_date, [site], site_data, str(site.id)
+            )
+            for site, site_data in zip(sites, data)
+        ]
+    content = await RENDER_EXECUTOR.render(
+        f"{RESOURCES_DIR}/consolidated_report.xlsx", sheets=sheets
+    )
+    if progress is not None:
+        progress.written += len(sheets)
+    REPORT_CACHE.put(
+        key,
+        content,
+        REPORT_CACHE.ttl_for(report_stop_date),
+        {"fetched": len(sites), "written": len(sheets)},
+    )
+    return content
+
+
+async def consolidated_report_stream(
+    report_start_date, report_stop_date, sites=None, layout="sheets"
+):
+    yield await consolidated_report_render(
+        report_start_date, report_stop_date, sites=sites, layout=layout
+    )
+
+
+async def consolidated_report_generator(
+    report_start_date,
+    report_stop_date,
+    filename=None,
+    progress=None,
+    format="xlsx",
+    sites=None,
+    layout="sheets",
+):
+    if format != "xlsx":
+        raise ValueError(f"Unsupported format {format}")
+    sites = sites or [SITES.primary]
+    content = await consolidated_report_render(
+        report_start_date, report_stop_date, progress, sites, layout
+    )
+    if filename is None:
+        filename = f"{cs.TEMPORARY_DIR}/{sites_label(sites)}_consolidated.xlsx"
+    with open(filename, "wb") as f:
+        f.write(content)
     return filename
 
 
+def convert_period(date_from, date_to):
+    start_date = datetime.strptime(date_from, "%d.%m.%Y")
+    end_date = datetime.strptime(date_to, "%d.%m.%Y")
+    return (
+        start_date.strftime("%Y-%m-%d 00:00:00"),
+        end_date.strftime("%Y-%m-%d 00:00:00"),
+    )
+
+
 @app.on_event("startup")
 async def startup():
-    await DBCONNECTOR.connect()
+    await LOGGER.getlogger()
+    await asyncio.gather(SITES.connect(), DBCONNECTOR_IS.connect())
+    TEMPLATE_CACHE.preload(f"{RESOURCES_DIR}/detailed_report.xlsx")
+    RENDER_EXECUTOR.start()
+    await JOBS.start(
+        {
+            "detailed": detailed_report_generator,
+            "consolidated": consolidated_report_generator,
+        }
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await JOBS.stop()
+    RENDER_EXECUTOR.shutdown()
+    await asyncio.gather(SITES.disconnect(), DBCONNECTOR_IS.disconnect())
+    await LOGGER.shutdown()
 
 
 @app.get("/")
 async def homepage(request: Request):
-    return TEMPLATES.TemplateResponse("index.html", {"request": request})
+    return TEMPLATES.TemplateResponse(
+        "index.html", {"request": request, "sites": list(SITES)}
+    )
 
 
 @app.post("/")
@@ -181,20 +585,105 @@ async def generate_report(
     option: str = Form(...),
     date_from: str = Form(...),
     date_to: str = Form(...),
+    format: str = Form("xlsx"),
+    sites: List[str] = Form([]),
+    layout: str = Form("sheets"),
+    profile: int = 0,
 ):
-    report = option
-    start_date = datetime.strptime(date_from, "%d.%m.%Y")
-    end_date = datetime.strptime(date_to, "%d.%m.%Y")
-    start_date_dt = start_date.strftime("%Y-%m-%d 00:00:00")
-    end_date_dt = end_date.strftime("%Y-%m-%d 00:00:00")
-    if option == "detailed":
-        enabled = True
-        filename = await detailed_report_generator(start_date_dt, end_date_dt)
-    elif option == "consolidated":
-        enabled = True
-        filename = await consolidated_report_generator(start_date_dt, end_date_dt)
+    start_date_dt, end_date_dt = convert_period(date_from, date_to)
+    profile = bool(profile) or PROFILE_SETTINGS.get("enabled", False)
+    try:
+        if format not in FORMATS.get(option, []) or layout not in LAYOUTS:
+            raise KeyError(format)
+        job = JOBS.submit(
+            option, start_date_dt, end_date_dt, format, profile, SITES.select(sites), layout
+        )
+    except (KeyError, asyncio.QueueFull):
+        return TEMPLATES.TemplateResponse(
+            "index.html",
+            {"request": request, "job": None, "rejected": True, "sites": list(SITES)},
+        )
     return TEMPLATES.TemplateResponse(
-        "index.html", {"request": request, "enabled": enabled}
+        "index.html", {"request": request, "job": job, "sites": list(SITES)}
+    )
+
+
+@app.post("/jobs")
+async def submit_job(
+    option: str = Form(...),
+    date_from: str = Form(...),
+    date_to: str = Form(...),
+    format: str = Form("xlsx"),
+    sites: List[str] = Form([]),
+    layout: str = Form("sheets"),
+    profile: int = 0,
+):
+    start_date_dt, end_date_dt = convert_period(date_from, date_to)
+    profile = bool(profile) or PROFILE_SETTINGS.get("enabled", False)
+    if format not in FORMATS.get(option, []) or layout not in LAYOUTS:
+        return Response(status_code=400)
+    try:
+        job = JOBS.submit(
+            option, start_date_dt, end_date_dt, format, profile, SITES.select(sites), layout
+        )
+    except KeyError:
+        return Response(status_code=400)
+    except asyncio.QueueFull:
+        return Response(status_code=503)
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        return Response(status_code=404)
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/profile")
+async def job_profile(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None or job.profile_summary is None:
+        return Response(status_code=404)
+    return FileResponse(
+        job.profile_filename,
+        media_type="text/plain; charset=utf-8",
+        filename=f"{sites_label(job.sites)}_{job.option}_{job.id}.folded",
+    )
+
+
+@app.post("/stream")
+async def stream_report(
+    option: str = Form(...),
+    date_from: str = Form(...),
+    date_to: str = Form(...),
+    format: str = Form("xlsx"),
+    sites: List[str] = Form([]),
+    layout: str = Form("sheets"),
+):
+    start_date_dt, end_date_dt = convert_period(date_from, date_to)
+    if option not in FORMATS:
+        return RedirectResponse("/", status_code=303)
+    if format not in FORMATS[option] or layout not in LAYOUTS:
+        return Response(status_code=400)
+    try:
+        sites = SITES.select(sites)
+    except KeyError:
+        return Response(status_code=400)
+    if option == "detailed":
+        content = detailed_report_stream(
+            start_date_dt, end_date_dt, format=format, sites=sites, layout=layout
+        )
+    else:
+        content = consolidated_report_stream(
+            start_date_dt, end_date_dt, sites=sites, layout=layout
+        )
+    filename = f"{sites_label(sites)}_{option}.{format}"
+    return StreamingResponse(
+        content,
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
@@ -202,15 +691,31 @@ async def return_homepage(request):
     await homepage()
 
 
-@app.get("/download")
-async def download_report(request: Request):
-    tasks = BackgroundTasks()
-    for file in os.listdir(TEMPORARY_DIR):
-        if file.endswith(".xlsx"):
-            basename = f"{TEMPORARY_DIR}/{file}"
-            tasks.add_task(os.remove, basename)
-            enabled = False
-            return FileResponse(basename, filename=file, background=tasks)
+@app.get("/metrics")
+async def metrics():
+    return Response(REGISTRY.exposition(), media_type=CONTENT_TYPE)
+
+
+@app.get("/cache")
+async def cache_stats():
+    return REPORT_CACHE.stats()
+
+
+@app.get("/pools")
+async def pool_stats():
+    return {**SITES.stats(), **DBCONNECTOR_IS.stats()}
+
+
+@app.get("/download/{job_id}")
+async def download_report(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None or job.status != "finished":
+        return Response(status_code=404)
+    return FileResponse(
+        job.filename,
+        media_type=MEDIA_TYPES[job.format],
+        filename=f"{sites_label(job.sites)}_{job.option}.{job.format}",
+    )
 
 
 def run():
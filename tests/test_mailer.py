@@ -0,0 +1,65 @@
+import asyncio
+import socket
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from modules.reports.notifier.mailer import Mailer, SMTPPool
+
+
+DATA = b'From: reports@example.com\r\nSubject: report\r\n\r\nbody\r\n'
+
+
+class Collector:
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return '250 OK'
+
+
+@pytest.fixture
+def smtpd():
+    collector = Collector()
+    controller = Controller(collector, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    yield controller, collector
+    controller.stop()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def send(port, addresses, retries=0):
+    mailer = Mailer(SMTPPool('127.0.0.1', port), 'reports@example.com', retries=retries, backoff=0)
+    try:
+        return await mailer.send_bytes(DATA, addresses)
+    finally:
+        await mailer.close()
+
+
+def test_every_recipient_gets_own_to_header(smtpd):
+    controller, collector = smtpd
+    addresses = ['a@example.com', 'b@example.com', 'c@example.com']
+    results = asyncio.run(send(controller.port, addresses + ['']))
+    assert sorted(r['address'] for r in results) == addresses
+    assert all(r['status'] == 'sent' and r['attempts'] == 1 and r['error'] is None for r in results)
+    received = {tuple(e.rcpt_tos): e.content for e in collector.envelopes}
+    assert sorted(received) == [(a,) for a in addresses]
+    for (address,), content in received.items():
+        assert content.startswith(f'To: {address}\r\n'.encode())
+        assert content.endswith(DATA)
+
+
+def test_unreachable_server_gives_failed_records():
+    results = asyncio.run(send(free_port(), ['a@example.com', 'b@example.com'], retries=2))
+    assert len(results) == 2
+    for result in results:
+        assert result['status'] == 'failed'
+        assert result['attempts'] == 3
+        assert result['error'] is not None
+        assert result['ts'] is not None
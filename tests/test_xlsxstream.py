@@ -0,0 +1,94 @@
+from datetime import datetime
+from decimal import Decimal
+
+import openpyxl
+import pytest
+from openpyxl.styles import Font
+
+from modules.reports.common.templates import CompiledTemplate
+from modules.reports.common.xlsxstream import ChunkSink, XlsxStreamWriter
+
+
+COLUMNS = 'ABCDEFGHIJKLMNOP'
+MERGED = ['A1:P1', 'A3:D3', 'A4:D4', 'A5:D5']
+
+
+@pytest.fixture
+def template(tmp_path):
+    # header block shaped like detailed_report.xlsx, column captions in row 8
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'report'
+    ws['A1'] = 'Detailed report'
+    ws['A1'].font = Font(bold=True)
+    ws['A3'] = 'Parking: '
+    ws['A4'] = 'Name: '
+    ws['A5'] = 'Period:'
+    for merged in MERGED:
+        ws.merge_cells(merged)
+    for i, column in enumerate(COLUMNS):
+        ws[f'{column}8'] = f'col{i}'
+    ws.column_dimensions['C'].width = 30
+    path = tmp_path / 'template.xlsx'
+    wb.save(path)
+    return CompiledTemplate(str(path))
+
+
+def rows(count, site):
+    return [(i, site, f'{i:012d}', i * 10, datetime(2026, 1, 1, 8, i % 60), datetime(2026, 1, 1, 9), None,
+             '1:00:00', 'A001AA77', Decimal('150.50'), Decimal('150.50'), 'card', Decimal('0'), 0,
+             f'{i:012d}', 'closed')
+            for i in range(1, count + 1)]
+
+
+def write(path, template, sheets):
+    sink = ChunkSink()
+    writer = None
+    with open(path, 'wb') as f:
+        for title, appends, sheet_rows in sheets:
+            if writer is None:
+                writer = XlsxStreamWriter(template, sink, appends=appends, title=title)
+            else:
+                writer.add_sheet(template, appends=appends, title=title)
+            for row in sheet_rows:
+                writer.append(row)
+            f.write(sink.drain())
+        writer.close()
+        f.write(sink.drain())
+    return writer
+
+
+def expected(row):
+    return tuple(float(v) if isinstance(v, Decimal) else v for v in row)
+
+
+def assert_sheet(ws, template, appends, sheet_rows):
+    assert ws['A1'].value == 'Detailed report'
+    assert ws['A1'].font.bold
+    for coordinate, value in appends.items():
+        assert ws[coordinate].value.endswith(value)
+    assert sorted(str(merged) for merged in ws.merged_cells.ranges) == sorted(MERGED)
+    assert ws.column_dimensions['C'].width == 30
+    assert [c.value for c in ws[8]] == [f'col{i}' for i in range(16)]
+    values = list(ws.iter_rows(min_row=len(template.rows) + 1, max_col=16, values_only=True))
+    assert values == [expected(row) for row in sheet_rows]
+
+
+def test_single_sheet_round_trip(tmp_path, template):
+    appends = {'A3': '1', 'A4': 'Parking 1', 'A5': ' 2026-01-01 - 2026-01-31'}
+    data = rows(1500, 1)
+    writer = write(tmp_path / 'out.xlsx', template, [('1', appends, data)])
+    assert writer.rows == len(data)
+    wb = openpyxl.load_workbook(tmp_path / 'out.xlsx')
+    assert wb.sheetnames == ['1']
+    assert_sheet(wb['1'], template, appends, data)
+
+
+def test_sheet_per_site_round_trip(tmp_path, template):
+    sheets = [(str(site), {'A3': str(site), 'A4': f'Parking {site}'}, rows(count, site))
+              for site, count in ((1, 200), (2, 0), (3, 50))]
+    write(tmp_path / 'out.xlsx', template, sheets)
+    wb = openpyxl.load_workbook(tmp_path / 'out.xlsx')
+    assert wb.sheetnames == ['1', '2', '3']
+    for title, appends, data in sheets:
+        assert_sheet(wb[title], template, appends, data)